@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Benchmark the freeZTP execution path end to end. Each run serves synthetic
+submissions from the JotForm stand-in (jotform_stub.py), runs
+worker.process_data for real against the fake freeZTP CLI (fake_ztp.py)
+in a scratch folder, and reports wall time and commands per second.
+
+Never run against production freeZTP. A temporary 'ztp' is placed first
+on PATH for the duration of the benchmark.
+
+Usage:
+    python3 -m jfit_ztp.bench --sizes 100,500,1500 --modes subprocess,batch
+"""
+
+# Python native modules
+import argparse
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import time
+from os import path
+
+# Private modules
+from . import jotform_stub
+from . import worker
+
+# Begin logging inside module, parent initializes configuration
+log = logging.getLogger(__name__)
+
+BENCH_CONFIG = {
+    'api_key': 'bench',
+    'form_id': jotform_stub.FORM_ID,
+    'delimiter': ':',
+    'keystore_type': 'cli',
+    'csv_path': None,
+    'import_unknown': False,
+    'null_answer': 'Select From List',
+    'bot_token': None,
+    'room_id': None,
+    'webhook_url': None,
+    'max_stack_size': 2,
+    'api_daily_limit': 100000,
+    'restart_ready_secs': 30,
+    'data_map': {
+        'keystore_id': {'q_text': 'Hostname', 'a_id': '1', 'a_idx': 0},
+        'idarray_1': {'q_text': 'Serial 1', 'a_id': '2', 'a_idx': 0},
+        'idarray_2': {'q_text': 'Serial 2', 'a_id': '3', 'a_idx': 0},
+        'model': {'q_text': 'Model', 'a_id': '2', 'a_idx': 1},
+        'association': {'q_text': 'Template', 'a_id': '4', 'a_idx': 0}
+    }
+}
+
+def install_fake_ztp(bin_dir):
+    """
+    Copy fake_ztp.py into bin_dir as an executable 'ztp'.
+        Parameters:
+            bin_dir (str): Folder placed first on PATH
+    """
+    source = path.join(path.dirname(path.abspath(__file__)), 'fake_ztp.py')
+    target = path.join(bin_dir, 'ztp')
+    shutil.copyfile(source, target)
+    os.chmod(target, os.stat(target).st_mode | stat.S_IXUSR | stat.S_IXGRP)
+
+def run_once(count, exec_mode, state_diff):
+    """
+    Run worker.process_data once in a scratch folder.
+        Parameters:
+            count (int): Submissions (devices) served by the stand-in
+            exec_mode (str): worker exec_mode ('subprocess', 'batch', 'config')
+            state_diff (bool): Compare against freeZTP state before applying
+        Returns:
+            result (dict): {'count', 'mode', 'cmds', 'exec_secs', 'wall_secs'}
+    """
+    counters = {'cmds': 0, 'exec_secs': 0.0}
+    real_exec_cmds = worker.exec_cmds
+
+    def timed_exec_cmds(cmd_set, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return real_exec_cmds(cmd_set, *args, **kwargs)
+        finally:
+            counters['cmds'] += len(cmd_set)
+            counters['exec_secs'] += time.perf_counter() - start
+
+    home = os.getcwd()
+    env_path = os.environ.get('PATH', '')
+    with tempfile.TemporaryDirectory(prefix='jfit-bench-') as work_dir:
+        bin_dir = path.join(work_dir, 'bin')
+        os.mkdir(bin_dir)
+        install_fake_ztp(bin_dir)
+        ztp_cfg = path.join(work_dir, 'ztp.cfg')
+        with open(ztp_cfg, 'w', encoding='utf-8') as cfg_file:
+            json.dump({'keyvalstore': {}, 'idarrays': {}, 'associations': {}},
+                      cfg_file)
+
+        config = dict(BENCH_CONFIG, exec_mode=exec_mode, state_diff=state_diff,
+                      ztp_config_path=ztp_cfg)
+        submissions = jotform_stub.build_submissions(config, count)
+        state = jotform_stub.StubState(submissions, daily_limit=100000)
+        server = jotform_stub.start_server(state, port=0)
+        config['jotform_url'] = f'http://127.0.0.1:{server.server_address[1]}'
+        with open(path.join(work_dir, 'datamap.json'), 'w',
+                  encoding='utf-8') as cfg_file:
+            json.dump(config, cfg_file, indent=4)
+
+        os.environ['PATH'] = bin_dir + os.pathsep + env_path
+        os.environ['FAKE_ZTP_CONFIG'] = ztp_cfg
+        worker.exec_cmds = timed_exec_cmds
+        os.chdir(work_dir)
+        try:
+            start = time.perf_counter()
+            worker.process_data('datamap.json', False)
+            wall_secs = time.perf_counter() - start
+        finally:
+            os.chdir(home)
+            worker.exec_cmds = real_exec_cmds
+            os.environ['PATH'] = env_path
+            server.shutdown()
+            server.server_close()
+
+    return {'count': count, 'mode': exec_mode, 'cmds': counters['cmds'],
+            'exec_secs': counters['exec_secs'], 'wall_secs': wall_secs}
+
+def main():
+    """ Run benchmark from command line """
+    parser = argparse.ArgumentParser(description='freeZTP exec path benchmark')
+    parser.add_argument('--sizes', default='100,500,1500',
+                        help='Comma separated device counts')
+    parser.add_argument('--modes', default='subprocess,batch,config',
+                        help='Comma separated exec modes')
+    parser.add_argument('--startup', default='0.05',
+                        help='Fake ztp start-up seconds per process')
+    parser.add_argument('--load', default='0',
+                        help='Fake ztp config load seconds per command')
+    parser.add_argument('--restart', default='1',
+                        help='Fake ztp seconds from restart to running')
+    parser.add_argument('--no-diff', action='store_true',
+                        help='Disable state_diff')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    os.environ['FAKE_ZTP_STARTUP'] = args.startup
+    os.environ['FAKE_ZTP_LOAD'] = args.load
+    os.environ['FAKE_ZTP_RESTART'] = args.restart
+
+    print(f'{"devices":>8} {"mode":>10} {"cmds":>7} {"exec s":>8} '
+          f'{"cmds/s":>8} {"wall s":>8}')
+    for count in [int(item) for item in args.sizes.split(',')]:
+        for mode in args.modes.split(','):
+            result = run_once(count, mode, not args.no_diff)
+            rate = result['cmds'] / result['exec_secs'] if result['exec_secs'] else 0
+            print(f'{result["count"]:>8} {result["mode"]:>10} '
+                  f'{result["cmds"]:>7} {result["exec_secs"]:>8.2f} '
+                  f'{rate:>8.1f} {result["wall_secs"]:>8.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Fake freeZTP CLI ('ztp') for exercising worker.exec_cmds and the restart
+scheduler without a real freeZTP install. Keeps state in a JSON file laid
+out like the freeZTP config (keyvalstore, idarrays, associations), so it
+also works with exec_mode 'config' and state_diff.
+
+Standalone on purpose: may be run directly or through ztp_batch.py.
+Install by copying (or linking) to a folder on PATH as 'ztp'.
+
+Environment:
+    FAKE_ZTP_CONFIG   State file. Default: ./fake_ztp.cfg
+    FAKE_ZTP_STARTUP  Seconds of start-up cost per process. Default: 0.05
+    FAKE_ZTP_LOAD     Seconds of config load cost per command. Default: 0
+    FAKE_ZTP_RESTART  Seconds before service reports running after a
+                      restart. Default: 1
+
+Supported commands:
+    ztp set keystore <id> <key> <value>
+    ztp clear keystore <id> <key | all>
+    ztp set idarray <id> <device id> [<device id> ...]
+    ztp set association id <id> template <template>
+    ztp clear association <id>
+    ztp service restart
+    ztp show status
+"""
+
+# Python native modules
+import json
+import os
+import sys
+import time
+
+def env_secs(name, default):
+    """ Read seconds value from environment """
+    return float(os.environ.get(name, default))
+
+def load_state(state_file):
+    """ Read state file. Empty state if absent. """
+    time.sleep(env_secs('FAKE_ZTP_LOAD', 0))
+    if os.path.exists(state_file):
+        with open(state_file, encoding='utf-8') as cfg_file:
+            return json.load(cfg_file)
+    return {}
+
+def save_state(state_file, state):
+    """ Write state file in one step """
+    tmp_name = f'{state_file}.{os.getpid()}.tmp'
+    with open(tmp_name, 'w', encoding='utf-8') as cfg_file:
+        json.dump(state, cfg_file, indent=4, sort_keys=True)
+    os.replace(tmp_name, state_file)
+
+def run(args, state):
+    """
+    Apply one command to state.
+        Parameters:
+            args (list): Command words after 'ztp'
+            state (dict): Fake freeZTP state (updated in place)
+        Returns:
+            rc (int): Exit code
+    """
+    store = state.setdefault('keyvalstore', {})
+    idarrays = state.setdefault('idarrays', {})
+    associations = state.setdefault('associations', {})
+
+    if args[:2] == ['set', 'keystore'] and len(args) >= 5:
+        store.setdefault(args[2], {})[args[3]] = ' '.join(args[4:])
+    elif args[:2] == ['clear', 'keystore'] and len(args) == 4:
+        if args[3] == 'all':
+            store.pop(args[2], None)
+        else:
+            store.get(args[2], {}).pop(args[3], None)
+    elif args[:2] == ['set', 'idarray'] and len(args) >= 3:
+        idarrays[args[2]] = args[3:]
+    elif args[:3] == ['set', 'association', 'id'] and len(args) == 6:
+        associations[args[3]] = args[5]
+    elif args[:2] == ['clear', 'association'] and len(args) == 3:
+        associations.pop(args[2], None)
+    elif args == ['service', 'restart']:
+        state['running_at'] = time.time() + env_secs('FAKE_ZTP_RESTART', 1)
+        state['restarts'] = state.get('restarts', 0) + 1
+        print('Restarting ztp.service')
+    elif args == ['show', 'status']:
+        if time.time() >= state.get('running_at', 0):
+            print('ztp.service - freeZTP (fake)\n   Active: active (running)')
+        else:
+            print('ztp.service - freeZTP (fake)\n   Active: activating (start)')
+        return 0
+    else:
+        print(f'Unsupported command: ztp {" ".join(args)}')
+        return 1
+
+    state['commands'] = state.get('commands', 0) + 1
+    return 0
+
+def main():
+    """ Entry point """
+    # Start-up cost only once per process, as with a real interpreter launch
+    if not getattr(sys, 'fake_ztp_started', False):
+        time.sleep(env_secs('FAKE_ZTP_STARTUP', 0.05))
+        sys.fake_ztp_started = True
+
+    state_file = os.environ.get('FAKE_ZTP_CONFIG', 'fake_ztp.cfg')
+    state = load_state(state_file)
+    rc = run(sys.argv[1:], state)
+    if rc == 0 and sys.argv[1:] != ['show', 'status']:
+        save_state(state_file, state)
+    sys.exit(rc)
+
+if __name__ == '__main__':
+    main()
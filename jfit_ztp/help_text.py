@@ -31,8 +31,12 @@ HELP_KEYSTORE_CONFIG_MENU = """
         All keystore and idarray information is stored in an external
         keystore file. Association data (template), if not using the
         default, MUST also be stored in the external keystore.
+    SQLITE
+        Same as CSV, but rows are kept in a database (sqlite_path) and
+        the external keystore is exported from it. Suited to very large
+        keystores. Seeded from the external keystore on first run.
 
-  Import Unknown (ONLY APPLIES TO CSV MODE)
+  Import Unknown (ONLY APPLIES TO CSV / SQLITE MODE)
     Default is FALSE.
     Enabling this feature will generate rows in the external keystore for
     non-present items. THIS MAY IMPACT JUST-IN-TIME DEPLOYMENT OPERATIONS.
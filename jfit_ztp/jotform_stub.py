@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Local JotForm API stand-in for load and integration testing. Serves the
+endpoints used by JFIT-ZTP with synthetic stack submissions built from a
+data map. Never point this at production freeZTP.
+
+Usage:
+    python3 -m jfit_ztp.jotform_stub --config datamap.json --count 500
+
+Then set "jotform_url": "http://127.0.0.1:8085" in the JFIT configuration.
+
+Endpoints:
+    GET  /form/{id}/submissions   filter (new, created_at:gt), orderby,
+                                  direction, limit, offset
+    GET  /form/{id}               Form properties incl. unread ('new') count
+    POST /submission/{id}         submission[new]=0 marks submission read
+    GET  /user/forms              One enabled form
+    GET  /user/usage              API calls served today
+"""
+
+# Python native modules
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+# Private modules
+from . import shared
+
+# Begin logging inside module, parent initializes configuration
+log = logging.getLogger(__name__)
+
+FORM_ID = '100000000000001'
+FORM_TITLE = 'JFIT Stub Form'
+
+def build_submissions(config, count, start_time=None, hosts=None):
+    """
+    Generate synthetic stack submissions matching a data map.
+        Parameters:
+            config (dict): JFIT configuration with 'data_map', 'delimiter'
+                and 'max_stack_size'
+            count (int): Number of submissions
+            start_time (datetime): Optional. created_at of first submission.
+            hosts (int): Optional. Distinct keystore IDs. Default is count.
+                Smaller values simulate resubmitted stacks.
+        Returns:
+            submissions (list): Submission dictionaries, oldest first
+    """
+    data_map = config['data_map']
+    delimiter = config['delimiter']
+    start_time = start_time or datetime.now() - timedelta(days=1)
+    hosts = hosts or count
+
+    # Answer elements per question ID, sized by the highest mapped index
+    widths = {}
+    for value in data_map.values():
+        widths[value['a_id']] = max(widths.get(value['a_id'], 1),
+                                    int(value['a_idx']) + 1)
+
+    submissions = []
+    for i in range(count):
+        host_num = i % hosts
+        elements = {a_id: ['-'] * width for a_id, width in widths.items()}
+        for key, value in data_map.items():
+            if 'keystore_id' in key:
+                data = f'STUB-SW{host_num:05d}'
+            elif 'idarray_' in key:
+                data = f'FOC{i:06d}{key[-1]}'
+            elif 'association' in key:
+                data = f'TEMPLATE{host_num % 4}'
+            else:
+                data = f'{key}-{host_num}'
+            elements[value['a_id']][int(value['a_idx'])] = data
+
+        answers = {}
+        for a_id, parts in elements.items():
+            answers[a_id] = {'text': f'Question {a_id}',
+                             'answer': f' {delimiter} '.join(parts)}
+
+        created_at = start_time + timedelta(seconds=i)
+        submissions.append({
+            'id': str(5000000000000000000 + i),
+            'form_id': FORM_ID,
+            'created_at': created_at.strftime(shared.JF_TIME_FORMAT),
+            'status': 'ACTIVE',
+            'new': '1',
+            'answers': answers
+        })
+
+    return submissions
+
+class StubState:
+    """
+    Shared state and fault settings for the stand-in server.
+        Parameters:
+            submissions (list): Submission dictionaries, oldest first
+            latency (float): Seconds added to every response
+            error_rate (float): Fraction of calls answered with HTTP 500
+            throttle_rate (float): Fraction of calls answered with HTTP 429
+            daily_limit (int): Calls reported as allowed per day
+    """
+    def __init__(self, submissions, latency=0.0, error_rate=0.0,
+                 throttle_rate=0.0, daily_limit=1000):
+        self.submissions = submissions
+        self.by_id = {item['id']: item for item in submissions}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.daily_limit = daily_limit
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def count_call(self):
+        """
+        Count API call and pick injected fault, if any.
+            Returns:
+                status (int): 200, or 429 / 500 for injected faults
+        """
+        with self.lock:
+            self.calls += 1
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return 200
+
+    def query(self, api_filter, limit, offset, orderby='created_at',
+              direction='DESC'):
+        """
+        Select page of submissions. Newest first unless asked otherwise, as
+        JotForm does.
+            Parameters:
+                api_filter (dict): JotForm filter (new, created_at:gt)
+                limit (int): Page size
+                offset (int): First position in result
+                orderby (str): Submission field to sort on
+                direction (str): 'ASC' or 'DESC'
+            Returns:
+                page (list): Matching submissions
+        """
+        created_gt = api_filter.get('created_at:gt')
+        with self.lock:
+            matches = [item for item in self.submissions
+                       if (api_filter.get('new') != '1' or item['new'] == '1')
+                       and (not created_gt or item['created_at'] > created_gt)]
+        # Submission ID breaks ties between submissions in the same second
+        matches.sort(key=lambda item: (item.get(orderby, ''), int(item['id'])),
+                     reverse=direction.upper() != 'ASC')
+        return matches[offset:offset + limit]
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    HTTP request handler for the stand-in. State on server.state.
+    """
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        log.debug('%s %s', self.address_string(), format % args)
+
+    def send_json(self, status, content, extra=None):
+        """
+        Send JotForm style JSON envelope.
+            Parameters:
+                status (int): HTTP status code
+                content: Value for 'content' field
+                extra (dict): Optional. Additional envelope fields.
+        """
+        state = self.server.state
+        body = {'responseCode': status,
+                'message': 'success' if status == 200 else 'error',
+                'content': content,
+                'limit-left': max(state.daily_limit - state.calls, 0)}
+        body.update(extra or {})
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_call(self):
+        """
+        Apply latency and faults. Returns True if handler should continue.
+        """
+        state = self.server.state
+        if state.latency:
+            time.sleep(state.latency)
+        status = state.count_call()
+        if status != 200:
+            self.send_json(status, None)
+            return False
+        return True
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """ Serve GET endpoints """
+        if not self.start_call():
+            return
+        state = self.server.state
+        url = urlparse(self.path)
+        query = dict(parse_qsl(url.query))
+        parts = url.path.strip('/').split('/')
+
+        if parts[0] == 'form' and len(parts) == 3 and parts[2] == 'submissions':
+            api_filter = json.loads(query.get('filter', '{}'))
+            limit = int(query.get('limit', 20))
+            offset = int(query.get('offset', 0))
+            page = state.query(api_filter, limit, offset,
+                               query.get('orderby', 'created_at'),
+                               query.get('direction', 'DESC'))
+            result_set = {'offset': offset, 'limit': limit, 'count': len(page)}
+            self.send_json(200, page, {'resultSet': result_set})
+        elif parts[0] == 'form' and len(parts) == 2:
+            with state.lock:
+                new = sum(1 for item in state.submissions if item['new'] == '1')
+            self.send_json(200, {'id': FORM_ID, 'title': FORM_TITLE,
+                                 'count': str(len(state.submissions)),
+                                 'new': str(new)})
+        elif parts == ['user', 'forms']:
+            forms = [{'id': FORM_ID, 'title': FORM_TITLE, 'status': 'ENABLED'}]
+            self.send_json(200, forms, {'resultSet': {'count': 1}})
+        elif parts == ['user', 'usage']:
+            self.send_json(200, {'api': str(state.calls)})
+        else:
+            self.send_json(404, None)
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """ Serve POST endpoints """
+        length = int(self.headers.get('Content-Length', 0))
+        form = dict(parse_qsl(self.rfile.read(length).decode('utf-8')))
+        if not self.start_call():
+            return
+        state = self.server.state
+        parts = urlparse(self.path).path.strip('/').split('/')
+
+        if parts[0] == 'submission' and len(parts) == 2:
+            with state.lock:
+                submission = state.by_id.get(parts[1])
+                if submission and 'submission[new]' in form:
+                    submission['new'] = form['submission[new]']
+            if submission:
+                self.send_json(200, {'submissionID': parts[1]})
+            else:
+                self.send_json(404, None)
+        else:
+            self.send_json(404, None)
+
+def start_server(state, host='127.0.0.1', port=8085):
+    """
+    Start stand-in server on a background thread.
+        Parameters:
+            state (StubState): Submissions and fault settings
+            host (str): Listen address
+            port (int): Listen port. 0 picks a free port.
+        Returns:
+            server (ThreadingHTTPServer): Running server. Base URL is
+                f'http://{host}:{server.server_address[1]}'
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.state = state
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    log.info('JotForm stand-in listening on http://%s:%d', host,
+             server.server_address[1])
+    return server
+
+def main():
+    """ Run stand-in from command line """
+    parser = argparse.ArgumentParser(description='Local JotForm API stand-in')
+    parser.add_argument('--config', default='datamap.json',
+                        help='JFIT configuration with data map')
+    parser.add_argument('--count', type=int, default=100,
+                        help='Synthetic submissions to serve')
+    parser.add_argument('--hosts', type=int, default=None,
+                        help='Distinct keystore IDs (default: count)')
+    parser.add_argument('--port', type=int, default=8085)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of calls answered with HTTP 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='Fraction of calls answered with HTTP 429')
+    parser.add_argument('--daily-limit', type=int, default=1000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config = shared.file_read_config(args.config)
+    if not config:
+        return
+
+    submissions = build_submissions(config, args.count, hosts=args.hosts)
+    state = StubState(submissions, args.latency, args.error_rate,
+                      args.throttle_rate, args.daily_limit)
+    server = start_server(state, port=args.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+CSV external keystore. Reads and writes the CSV file freeZTP uses, with
+optional row streaming ('csv_stream'), an in-memory parsed-keystore cache
+and a keystore change log (write-ahead log, 'ks_wal') folded into the CSV
+before freeZTP restarts.
+"""
+
+# Python native modules
+from os import path
+import os
+import logging
+import csv
+import io
+import hashlib
+import json
+
+# Private modules
+from . import shared
+from . import ks_table
+
+# Begin logging inside module, parent initializes configuration
+log = logging.getLogger(__name__)
+
+# Parsed external keystores by absolute path. Reused while file unchanged.
+KS_CACHE = {}
+
+def file_read_ext_ks(ext_keystore_file, keystore_ids=None):
+    """
+    Read external keystore fields / rows
+        Parameters:
+            ext_keystore_file (str): Absolute or relative path
+            keystore_ids (list): Optional. Keep only rows for these IDs (any
+                case). Other rows are read past, not stored.
+        Returns:
+            headers (list): First row of CSV file (csv_data.fields)
+            csv_data (KeystoreTable): Row data using 'keystore_id' as key
+                value. Reads like a dict of row dicts (see ks_table.py).
+                ex. {'MYHOST': {'keystore_id': 'myhost', 'var': 'value'}}
+    """
+    headers = None
+    csv_data = None
+
+    if path.exists(ext_keystore_file):
+        log.debug('Importing external keystore file, %s',  ext_keystore_file)
+        with open(ext_keystore_file, 'r', encoding='utf-8') as csv_file:
+            reader = csv.reader(csv_file)
+            csv_data = ks_table.KeystoreTable(next(reader, []))
+            headers = csv_data.fields
+            id_pos = headers.pos.get('keystore_id', 0)
+            keep = None
+            if keystore_ids is not None:
+                keep = {item.upper() for item in keystore_ids}
+            # Rows kept as value lists keyed on keystore_id. Blank lines
+            # skipped, as csv.DictReader does.
+            for row in reader:
+                if not row:
+                    continue
+                ks_key = row[id_pos].upper()
+                if keep is None or ks_key in keep:
+                    csv_data.add_list(ks_key, row)
+            log.info('Read %d lines from external keystore. %d row(s) kept.',
+                     reader.line_num, len(csv_data))
+
+    else:
+        log.warning('Keystore missing. Verify file and path. Current: %s',
+                    ext_keystore_file)
+
+    return headers, csv_data
+
+def file_write_ext_ks(ext_keystore_file, headers, csv_data):
+    """
+    Update external keystore fields / rows from JotForm Data. File replaced
+    in one step (see shared.file_write_atomic). Skipped if the content
+    would not change.
+        Parameters:
+            ext_keystore_file (str): Absolute or relative path
+            headers (list): First row of CSV file (csv_data.fields)
+            csv_data (KeystoreTable): Row data using 'keystore_id' as key
+                value. See file_read_ext_ks.
+        Returns:
+            changed (bool): True if file was written
+    """
+    i = 0
+
+    csv_text = io.StringIO()
+    writer = csv.writer(csv_text)
+    writer.writerow(headers)
+    # Row value lists are already in header order
+    for values in csv_data.iter_lists():
+        writer.writerow(values)
+        i += 1
+    csv_text = csv_text.getvalue()
+
+    new_hash = hashlib.sha256(csv_text.encode('utf-8')).hexdigest()
+    if new_hash == shared.file_sha256(ext_keystore_file):
+        log.info('External keystore unchanged. File not written.')
+        return False
+
+    shared.file_write_atomic(ext_keystore_file, csv_text)
+    log.info('Wrote %d line(s) to external keystore.', i)
+    return True
+
+def file_patch_ext_ks(ext_keystore_file, headers, csv_data):
+    """
+    Stream external keystore into a temp file row by row, replacing rows
+    found in csv_data and appending the rest. Only csv_data is held in
+    memory. File replaced in one step if anything changed.
+        Parameters:
+            ext_keystore_file (str): Absolute or relative path
+            headers (list): Header values, possibly updated
+            csv_data (KeystoreTable): Changed rows using 'keystore_id' as key
+                value
+                ex. {'MYHOST': {'keystore_id': 'myhost', 'var': 'value'}}
+        Returns:
+            changed (bool): True if file was written
+    """
+    pending = dict(csv_data)
+    patched = 0
+    i = 0
+
+    with open(ext_keystore_file, 'r', encoding='utf-8') as csv_file, \
+            shared.AtomicFile(ext_keystore_file) as tmp:
+        reader = csv.DictReader(csv_file)
+        changed = reader.fieldnames != headers
+        writer = csv.DictWriter(tmp.file, fieldnames=headers)
+        writer.writeheader()
+        for row in reader:
+            new_row = pending.pop(row['keystore_id'].upper(), None)
+            if new_row is not None and csv_rows_differ(new_row, row):
+                row = new_row
+                patched += 1
+            writer.writerow(row)
+            i += 1
+
+        # Rows not in file are new (Import Unknown)
+        for row in pending.values():
+            writer.writerow(row)
+            i += 1
+
+        if not (changed or patched or pending):
+            log.info('External keystore unchanged. File not written.')
+            return False
+        tmp.commit()
+
+    log.info('Wrote %d line(s) to external keystore. %d patched, %d added.',
+             i, patched, len(pending))
+    return True
+
+def csv_text(value):
+    """
+    Field value as read back from the CSV file.
+        Parameters:
+            value: Field value. None is written as an empty field.
+        Returns:
+            text (str): ex. '' for None
+    """
+    return '' if value is None else str(value)
+
+def csv_rows_differ(row, other):
+    """
+    Compare two rows as they would be written to the CSV file.
+        Parameters:
+            row (dict): Row data keyed on header
+            other (dict): Row data keyed on header
+        Returns:
+            differ (bool): True if any field would be written differently
+    """
+    return any(csv_text(row.get(key)) != csv_text(other.get(key))
+               for key in set(row) | set(other))
+
+def read_ext_ks(cfg, keystore_ids):
+    """
+    Read CSV keystore per 'csv_stream' (else through the cache), then replay
+    the keystore change log (write-ahead log), if one is pending.
+        Parameters:
+            cfg (dict): Current configuration data
+            keystore_ids (list): IDs about to be updated. Only these rows
+                are loaded in 'csv_stream' mode.
+        Returns:
+            See file_read_ext_ks
+    """
+    keep = None
+    if cfg['csv_stream']:
+        keep = {item.upper() for item in keystore_ids}
+        headers, csv_data = file_read_ext_ks(cfg['csv_path'], keep)
+    else:
+        headers, csv_data = cache_read_ext_ks(cfg)
+
+    records = file_read_ks_wal(f"{cfg['csv_path']}.wal")
+    if csv_data is not None and records:
+        headers, csv_data = replay_ks_wal(headers, csv_data, records, keep)
+
+    return headers, csv_data
+
+def write_ext_ks(cfg, headers, csv_data):
+    """
+    Write CSV keystore per 'csv_stream'. Cache updated with content written.
+        Parameters:
+            cfg (dict): Current configuration data
+            headers (list): First row of CSV file
+            csv_data (KeystoreTable): Row data. See file_read_ext_ks.
+        Returns:
+            changed (bool): True if file was written
+    """
+    if cfg['csv_stream']:
+        return file_patch_ext_ks(cfg['csv_path'], headers, csv_data)
+
+    changed = file_write_ext_ks(cfg['csv_path'], headers, csv_data)
+    if changed:
+        cache_store_ext_ks(cfg, headers, csv_data)
+    return changed
+
+def file_read_ks_wal(wal_file):
+    """
+    Read keystore change log (write-ahead log).
+        Parameters:
+            wal_file (str): Relative or absolute path. ex. 'keystore.csv.wal'
+        Returns:
+            records (list): Changes in the order made. Empty if file absent.
+                ex. [{'ts': <epoch>, 'keystore_id': 'myhost',
+                      'set': {'var': 'value'}}]
+    """
+    records = []
+    if path.exists(wal_file):
+        with open(wal_file, encoding='utf-8') as wal:
+            for line in wal:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Partial last line from an interrupted write
+                    log.debug('Skipped unreadable change log line: %s', line)
+
+    return records
+
+def file_append_ks_wal(wal_file, records):
+    """
+    Append keystore changes to the change log.
+        Parameters:
+            wal_file (str): Relative or absolute path. ex. 'keystore.csv.wal'
+            records (list): See file_read_ks_wal
+        Returns:
+            changed (bool): True if any records were written
+    """
+    if not records:
+        log.info('External keystore unchanged. Nothing logged.')
+        return False
+
+    with open(wal_file, 'a', encoding='utf-8') as wal:
+        for record in records:
+            wal.write(json.dumps(record) + '\n')
+        wal.flush()
+        os.fsync(wal.fileno())
+
+    log.info('Logged %d keystore change(s) to %s.', len(records), wal_file)
+    return True
+
+def log_ext_ks(cfg, records):
+    """
+    Record keystore changes in the change log ('<csv_path>.wal'). The CSV
+    itself is updated when the log is folded in (see compact_ext_ks).
+        Parameters:
+            cfg (dict): Current configuration data
+            records (list): See file_read_ks_wal
+        Returns:
+            changed (bool): True if any records were written
+            compact (bool): True if the log reached 'ks_wal_max' records
+    """
+    wal_file = f"{cfg['csv_path']}.wal"
+    changed = file_append_ks_wal(wal_file, records)
+    compact = len(file_read_ks_wal(wal_file)) >= cfg['ks_wal_max']
+    return changed, compact
+
+def replay_ks_wal(headers, csv_data, records, keep=None):
+    """
+    Apply change log records over keystore data read from the CSV.
+        Parameters:
+            headers (list): First row of CSV file
+            csv_data (KeystoreTable): Row data. See file_read_ext_ks.
+            records (list): See file_read_ks_wal
+            keep (set): Optional. Upper case IDs loaded. Others skipped.
+        Returns:
+            headers (list): Header values, possibly updated
+            csv_data (KeystoreTable): Row data with changes applied
+    """
+    for record in records:
+        ks_key = record['keystore_id'].upper()
+        if keep is not None and ks_key not in keep:
+            continue
+        csv_data.setdefault(ks_key, {'keystore_id': record['keystore_id']})
+        row = csv_data[ks_key]
+        # Setting a value adds its header, if missing
+        for key, value in record['set'].items():
+            row[key] = value
+
+    log.info('Replayed %d keystore change(s) from change log.', len(records))
+    return csv_data.fields, csv_data
+
+def compact_ext_ks(cfg):
+    """
+    Fold keystore change log into the CSV file, then clear the log. Folded
+    records are kept in '<csv_path>.history' with 'ks_wal_history'.
+        Parameters:
+            cfg (dict): Current configuration data
+        Returns:
+            compacted (bool): False if keystore busy or missing. Log kept.
+    """
+    wal_file = f"{cfg['csv_path']}.wal"
+    if not path.exists(wal_file):
+        return True
+
+    with shared.FileLock(f"{cfg['csv_path']}.lock") as ks_lock:
+        if not ks_lock.acquire(cfg['ks_lock_timeout']):
+            return False
+
+        records = file_read_ks_wal(wal_file)
+        headers, csv_data = read_ext_ks(
+            cfg, [record['keystore_id'] for record in records])
+        if csv_data is None:
+            # Error logged in file_read_ext_ks
+            return False
+
+        write_ext_ks(cfg, headers, csv_data)
+        if cfg['ks_wal_history']:
+            with open(f"{cfg['csv_path']}.history", 'a',
+                      encoding='utf-8') as history:
+                for record in records:
+                    history.write(json.dumps(record) + '\n')
+        os.remove(wal_file)
+
+    log.info('Folded %d change log record(s) into external keystore.',
+             len(records))
+    return True
+
+def ks_cache_key(ext_keystore_file, use_hash):
+    """
+    Identity of the external keystore file as it is now.
+        Parameters:
+            ext_keystore_file (str): Absolute or relative path
+            use_hash (bool): Include SHA-256 of the contents
+        Returns:
+            key (list): [abs path, mtime_ns, size] plus digest if use_hash
+    """
+    stat = os.stat(ext_keystore_file)
+    key = [path.abspath(ext_keystore_file), stat.st_mtime_ns, stat.st_size]
+    if use_hash:
+        key.append(shared.file_sha256(ext_keystore_file))
+    return key
+
+def cache_read_ext_ks(cfg):
+    """
+    Read external keystore through the parsed-keystore cache (this process
+    only). The file is parsed unless the cached copy matches its current
+    path, mtime, size and (with 'ks_cache_hash') contents. Saves a parse
+    when one run reads the keystore again, e.g. to fold the change log.
+        Parameters:
+            cfg (dict): Current configuration data
+        Returns:
+            See file_read_ext_ks. Caller owns the returned data.
+    """
+    ext_keystore_file = cfg['csv_path']
+    if not path.exists(ext_keystore_file):
+        # Warning logged in file_read_ext_ks
+        return file_read_ext_ks(ext_keystore_file)
+
+    key = ks_cache_key(ext_keystore_file, cfg['ks_cache_hash'])
+    entry = KS_CACHE.get(key[0])
+    if entry and entry['key'] == key:
+        log.info('External keystore unchanged. Using cached copy (%d rows).',
+                 len(entry['csv_data']))
+        return copy_ext_ks(entry['headers'], entry['csv_data'])
+
+    headers, csv_data = file_read_ext_ks(ext_keystore_file)
+    if csv_data is not None:
+        store_ks_cache(key, headers, csv_data)
+    return headers, csv_data
+
+def cache_store_ext_ks(cfg, headers, csv_data):
+    """
+    Remember keystore content just written, so the next read skips parsing.
+        Parameters:
+            cfg (dict): Current configuration data
+            headers (list): First row of CSV file
+            csv_data (KeystoreTable): Row data as written
+    """
+    key = ks_cache_key(cfg['csv_path'], cfg['ks_cache_hash'])
+    store_ks_cache(key, headers, csv_data)
+
+def store_ks_cache(key, headers, csv_data):
+    """
+    Save parsed keystore to memory cache.
+        Parameters:
+            key (list): See ks_cache_key
+            headers (list): First row of CSV file
+            csv_data (KeystoreTable): Row data. Copied, caller may keep
+                changing it.
+    """
+    headers, csv_data = copy_ext_ks(headers, csv_data)
+    entry = {'key': key, 'headers': headers, 'csv_data': csv_data}
+    KS_CACHE[key[0]] = entry
+
+def copy_ext_ks(headers, csv_data):
+    """
+    Copy of parsed keystore, so cached data is never changed in place.
+        Parameters:
+            headers (list): First row of CSV file (csv_data.fields)
+            csv_data (KeystoreTable): Row data using 'keystore_id' as key value
+        Returns:
+            headers (list), csv_data (KeystoreTable): Copies
+    """
+    csv_data = csv_data.copy()
+    return (csv_data.fields if headers is not None else None), csv_data
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Sharded external keystore. Rows are split across per-site (or per-prefix)
+CSV files, chosen by a regular expression on the keystore ID. A batch
+reads and rewrites only the shards holding its keystore IDs. An index
+file lists every shard with its headers, and is used to build the single
+merged CSV that freeZTP reads. The merge waits until freeZTP is about to
+restart, so several batches share one merge.
+
+Shard folder layout:
+    index.json        {'headers': [<union of shard headers>],
+                       'shards': {'<name>': {'file': '<name>.csv',
+                                             'headers': [<list>],
+                                             'rows': <int>}},
+                       'merged_stat': [<size>, <mtime_ns>],
+                       'merge_pending': <bool>}
+    <name>.csv        One shard
+
+Usage (merge shards by hand, e.g. for an export step):
+    python3 -m jfit_ztp.ks_shard <shard folder> <output csv>
+"""
+
+# Python native modules
+from os import path
+import os
+import re
+import csv
+import json
+import logging
+import argparse
+
+# Private modules
+from . import shared
+from . import ks_csv
+from . import ks_table
+
+# Begin logging inside module, parent initializes configuration
+log = logging.getLogger(__name__)
+
+INDEX_NAME = 'index.json'
+
+# Shard for keystore IDs the rule does not match
+DEFAULT_SHARD = '_default'
+
+def shard_dir(cfg):
+    """
+    Folder holding shard files.
+        Parameters:
+            cfg (dict): Current configuration data
+        Returns:
+            folder (str): 'ks_shard_dir', or '<csv_path>.shards' if not set
+    """
+    return cfg['ks_shard_dir'] or f"{cfg['csv_path']}.shards"
+
+def shard_name(rule, keystore_id):
+    """
+    Shard for a keystore ID. Rule is matched against the upper case ID.
+    First capture group names the shard (whole match if no group).
+        Parameters:
+            rule (str): Regular expression. ex. '^([^-]+)-' (site code)
+            keystore_id (str): ID value, typically device hostname
+        Returns:
+            name (str): File safe shard name. ex. 'NYC01'
+    """
+    match = re.search(rule, keystore_id.upper())
+    if not match:
+        return DEFAULT_SHARD
+    name = match.group(1) if match.groups() else match.group(0)
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name) or DEFAULT_SHARD
+
+def shard_path(folder, name):
+    """
+    Shard file path.
+        Parameters:
+            folder (str): Shard folder
+            name (str): Shard name (see shard_name)
+        Returns:
+            shard_file (str): ex. '<folder>/NYC01.csv'
+    """
+    return path.join(folder, f'{name}.csv')
+
+def file_read_index(folder):
+    """
+    Read shard index.
+        Parameters:
+            folder (str): Shard folder
+        Returns:
+            index (dict): See module docstring. None if absent.
+    """
+    index_file = path.join(folder, INDEX_NAME)
+    if not path.exists(index_file):
+        return None
+    with open(index_file, encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+def file_write_index(folder, index):
+    """
+    Save shard index.
+        Parameters:
+            folder (str): Shard folder
+            index (dict): See module docstring
+    """
+    shared.file_write_atomic(path.join(folder, INDEX_NAME),
+                             json.dumps(index, indent=4))
+
+def merge_shards(folder, index, csv_path):
+    """
+    Write every shard, in shard name order, into one CSV. Shards whose
+    headers match the merged headers are copied without parsing. Others
+    are parsed and their columns lined up. Records merged file in index.
+        Parameters:
+            folder (str): Shard folder
+            index (dict): See module docstring (updated in place)
+            csv_path (str): Merged CSV. ex. external keystore read by freeZTP
+    """
+    headers = index['headers']
+    with shared.AtomicFile(csv_path) as tmp:
+        writer = csv.writer(tmp.file)
+        writer.writerow(headers)
+        for name in sorted(index['shards']):
+            shard = index['shards'][name]
+            with open(path.join(folder, shard['file']), 'r', newline='',
+                      encoding='utf-8') as shard_file:
+                if shard['headers'] == headers:
+                    shard_file.readline()
+                    tmp.file.write(shard_file.read())
+                    continue
+                reader = csv.reader(shard_file)
+                positions = [headers.index(item) for item in next(reader, [])]
+                for row in reader:
+                    values = [None] * len(headers)
+                    for pos, value in zip(positions, row):
+                        values[pos] = value
+                    writer.writerow(values)
+        tmp.commit()
+
+    index['merged_stat'] = shared.file_stat(csv_path)
+    log.info('Merged %d shard(s) into external keystore, %s',
+             len(index['shards']), csv_path)
+
+def read_ext_ks_shards(cfg, keystore_ids):
+    """
+    Read only the keystore shards holding keystore_ids.
+    Shards are (re)built from the CSV keystore first if there are none yet,
+    or if the CSV was changed outside JFIT since it was last merged. Not
+    while shard changes wait to be merged; those would be lost.
+        Parameters:
+            cfg (dict): Current configuration data
+            keystore_ids (list): IDs about to be updated
+        Returns:
+            See ks_csv.file_read_ext_ks. Rows of the loaded shards only.
+    """
+    folder = shard_dir(cfg)
+    index = file_read_index(folder)
+    edited = index is not None and (shared.file_stat(cfg['csv_path'])
+                                    not in (None, index['merged_stat']))
+    if edited and index.get('merge_pending'):
+        log.warning('External keystore %s changed outside JFIT while shard '
+                    'changes wait to be merged. Shards kept. The change is '
+                    'overwritten by the next merge.', cfg['csv_path'])
+    elif index is None or edited:
+        index = split_ext_ks(cfg, folder)
+        if index is None:
+            # Warning logged in ks_csv.file_read_ext_ks
+            return None, None
+
+    names = {shard_name(cfg['ks_shard_rule'], item)
+             for item in keystore_ids}
+    csv_data = ks_table.KeystoreTable(index['headers'])
+    for name in sorted(names & set(index['shards'])):
+        shard_file = path.join(folder, index['shards'][name]['file'])
+        headers, shard_data = ks_csv.file_read_ext_ks(shard_file)
+        if shard_data is None:
+            continue
+        if headers == csv_data.fields:
+            csv_data.rows.update(shard_data.rows)
+        else:
+            for ks_key in shard_data:
+                csv_data[ks_key] = shard_data[ks_key]
+
+    log.info('Loaded %d of %d keystore shard(s).', len(names & set(
+        index['shards'])), len(index['shards']))
+    return csv_data.fields, csv_data
+
+def write_ext_ks_shards(cfg, headers, csv_data):
+    """
+    Write each shard in csv_data that changed. Other shards and the merged
+    CSV keystore are not touched. The merge is marked pending and done by
+    merge_ext_ks_shards before freeZTP restarts.
+        Parameters:
+            cfg (dict): Current configuration data
+            headers (list): First row of CSV file (csv_data.fields)
+            csv_data (KeystoreTable): Rows of the loaded shards
+        Returns:
+            changed (bool): True if any shard was written
+    """
+    folder = shard_dir(cfg)
+    index = file_read_index(folder)
+    changed = write_shards(cfg, folder, index, headers, csv_data)
+    if changed:
+        index['headers'] = list(headers)
+        index['merge_pending'] = True
+        file_write_index(folder, index)
+    return changed
+
+def merge_ext_ks_shards(cfg):
+    """
+    Merge shards into the CSV keystore if batches changed them since the
+    last merge. Run just before freeZTP restarts (it reads the keystore on
+    restart).
+        Parameters:
+            cfg (dict): Current configuration data
+        Returns:
+            merged (bool): False if keystore busy. Merge stays pending.
+    """
+    folder = shard_dir(cfg)
+    with shared.FileLock(f"{cfg['csv_path']}.lock") as ks_lock:
+        if not ks_lock.acquire(cfg['ks_lock_timeout']):
+            return False
+
+        index = file_read_index(folder)
+        if not index or not index.get('merge_pending'):
+            return True
+
+        merge_shards(folder, index, cfg['csv_path'])
+        index['merge_pending'] = False
+        file_write_index(folder, index)
+
+    return True
+
+def split_ext_ks(cfg, folder):
+    """
+    Split the CSV keystore into shard files and start a new index.
+        Parameters:
+            cfg (dict): Current configuration data
+            folder (str): Shard folder. Created if absent.
+        Returns:
+            index (dict): See py. None if CSV keystore missing.
+    """
+    headers, csv_data = ks_csv.file_read_ext_ks(cfg['csv_path'])
+    if csv_data is None:
+        return None
+
+    os.makedirs(folder, exist_ok=True)
+    old = file_read_index(folder)
+    index = {'headers': list(headers), 'shards': {}, 'merged_stat': None,
+             'merge_pending': False}
+    write_shards(cfg, folder, index, headers, csv_data)
+
+    # Shards no longer in the CSV keystore
+    for name in set(old['shards'] if old else ()) - set(index['shards']):
+        os.remove(path.join(folder, old['shards'][name]['file']))
+
+    index['merged_stat'] = shared.file_stat(cfg['csv_path'])
+    file_write_index(folder, index)
+    log.info('Split external keystore into %d shard(s) in %s',
+             len(index['shards']), folder)
+    return index
+
+def write_shards(cfg, folder, index, headers, csv_data):
+    """
+    Group rows by shard and write each shard file that changed.
+        Parameters:
+            cfg (dict): Current configuration data
+            folder (str): Shard folder
+            index (dict): See py (updated in place)
+            headers (list): First row of CSV file (csv_data.fields)
+            csv_data (KeystoreTable): Rows to write, whole shards only
+        Returns:
+            changed (bool): True if any shard file was written
+    """
+    shards = {}
+    for ks_key, values in csv_data.rows.items():
+        name = shard_name(cfg['ks_shard_rule'], ks_key)
+        shard_data = shards.setdefault(name, ks_table.KeystoreTable(headers))
+        shard_data.rows[ks_key] = values
+
+    changed = False
+    for name, shard_data in shards.items():
+        shard_file = shard_path(folder, name)
+        if ks_csv.file_write_ext_ks(shard_file, shard_data.fields, shard_data):
+            changed = True
+        index['shards'][name] = {'file': path.basename(shard_file),
+                                 'headers': list(shard_data.fields),
+                                 'rows': len(shard_data)}
+
+    return changed
+
+def main():
+    """ Merge shards from command line """
+    parser = argparse.ArgumentParser(description='Merge keystore shards')
+    parser.add_argument('folder', help='Shard folder (holds index.json)')
+    parser.add_argument('output', help='Merged CSV file to write')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    index = file_read_index(args.folder)
+    if index is None:
+        log.warning('No %s in %s', INDEX_NAME, args.folder)
+        return
+    merge_shards(args.folder, index, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+SQLite external keystore. Rows are held in a database indexed on keystore
+ID, so a batch reads and writes only the rows it touches. freeZTP still
+reads a CSV file, which is exported from the database after each change.
+
+The database is seeded from the existing CSV keystore on first use, and
+reloaded from it if the CSV is edited outside JFIT.
+"""
+
+# Python native modules
+from os import path
+import logging
+import sqlite3
+import json
+import csv
+import io
+import hashlib
+import shutil
+
+# Private modules
+from . import shared
+from . import ks_table
+
+# Begin logging inside module, parent initializes configuration
+log = logging.getLogger(__name__)
+
+# Keystore IDs per SELECT. Stays below SQLite host parameter limit (999).
+QUERY_CHUNK = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fields (
+    pos INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS rows (
+    keystore_id TEXT PRIMARY KEY,
+    added INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL);
+'''
+
+def open_keystore(db_path, csv_path):
+    """
+    Open keystore database. Seed from CSV keystore if new or if the CSV
+    changed since it was last exported (e.g. edited by hand).
+        Parameters:
+            db_path (str): Relative or absolute path. ex. 'keystore.db'
+            csv_path (str): External keystore read by freeZTP
+        Returns:
+            conn (obj): sqlite3 Connection
+    """
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    if get_meta(conn, 'version') is None:
+        import_csv(conn, csv_path)
+    elif shared.file_stat(csv_path) not in (None,
+                                            get_meta(conn, 'exported_stat')):
+        log.warning('External keystore changed outside JFIT. Reloading %s',
+                    csv_path)
+        import_csv(conn, csv_path)
+    return conn
+
+def get_meta(conn, name, default=None):
+    """
+    Read one keystore state value.
+        Parameters:
+            conn (obj): sqlite3 Connection
+            name (str): ex. 'version', 'exported_version'
+            default: Returned if value not set
+        Returns:
+            value: Decoded JSON value
+    """
+    row = conn.execute('SELECT value FROM meta WHERE name = ?',
+                       (name,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def set_meta(conn, name, value):
+    """
+    Save one keystore state value. Caller commits.
+        Parameters:
+            conn (obj): sqlite3 Connection
+            name (str): ex. 'version', 'exported_version'
+            value: Any JSON serializable value
+    """
+    conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+                 (name, json.dumps(value)))
+
+def get_fields(conn):
+    """
+    CSV headers in file order.
+        Parameters:
+            conn (obj): sqlite3 Connection
+        Returns:
+            headers (list): ex. ['keystore_id', 'var_1', 'var_x']
+    """
+    return [row[0] for row in
+            conn.execute('SELECT name FROM fields ORDER BY pos')]
+
+def import_csv(conn, csv_path):
+    """
+    Replace database contents with the CSV keystore. Missing file gives an
+    empty keystore.
+        Parameters:
+            conn (obj): sqlite3 Connection
+            csv_path (str): Absolute or relative path
+    """
+    headers = []
+    rows = []
+    if csv_path and path.exists(csv_path):
+        with open(csv_path, 'r', encoding='utf-8') as csv_file:
+            reader = csv.DictReader(csv_file)
+            headers = reader.fieldnames or []
+            for row in reader:
+                rows.append((row['keystore_id'].upper(), json.dumps(row)))
+        log.info('Imported %d row(s) from %s into keystore database.',
+                 len(rows), csv_path)
+    else:
+        log.warning('Keystore missing. Starting empty keystore database. '
+                    'Current: %s', csv_path)
+
+    with conn:
+        conn.execute('DELETE FROM fields')
+        conn.execute('DELETE FROM rows')
+        conn.executemany('INSERT INTO fields (pos, name) VALUES (?, ?)',
+                         enumerate(headers))
+        conn.executemany('INSERT OR REPLACE INTO rows (keystore_id, added, '
+                         'version, data) VALUES (?, 1, 1, ?)', rows)
+        set_meta(conn, 'version', 1)
+        # CSV already matches the database
+        stat = shared.file_stat(csv_path)
+        set_meta(conn, 'exported_version', 1 if stat else 0)
+        set_meta(conn, 'exported_fields', len(headers))
+        set_meta(conn, 'exported_stat', stat)
+
+def read_rows(conn, keystore_ids):
+    """
+    Read only the requested keystore rows.
+        Parameters:
+            conn (obj): sqlite3 Connection
+            keystore_ids (list): Keystore IDs (any case)
+        Returns:
+            headers (list): CSV headers (csv_data.fields)
+            csv_data (KeystoreTable): Rows found, keyed on upper case
+                keystore_id. See ks_table.py.
+                ex. {'MYHOST': {'keystore_id': 'myhost', 'var': 'value'}}
+    """
+    keys = sorted({item.upper() for item in keystore_ids})
+    csv_data = ks_table.KeystoreTable(get_fields(conn))
+    for start in range(0, len(keys), QUERY_CHUNK):
+        chunk = keys[start:start + QUERY_CHUNK]
+        marks = ','.join('?' * len(chunk))
+        query = ('SELECT keystore_id, data FROM rows WHERE keystore_id IN '
+                 f'({marks})')
+        for ks_key, data in conn.execute(query, chunk):
+            csv_data[ks_key] = json.loads(data)
+
+    log.info('Read %d of %d keystore row(s) from database.', len(csv_data),
+             len(keys))
+    return csv_data.fields, csv_data
+
+def update_keystore(conn, csv_path, headers, csv_data):
+    """
+    Save changed rows in one transaction, then export the CSV keystore.
+        Parameters:
+            conn (obj): sqlite3 Connection
+            csv_path (str): External keystore read by freeZTP
+            headers (list): CSV headers, possibly updated
+            csv_data (dict): Rows to save. See read_rows.
+        Returns:
+            changed (bool): True if CSV keystore was written
+    """
+    version = get_meta(conn, 'version') + 1
+    changed = 0
+    with conn:
+        fields = get_fields(conn)
+        for name in (headers or []):
+            if name not in fields:
+                conn.execute('INSERT INTO fields (pos, name) VALUES (?, ?)',
+                             (len(fields), name))
+                fields.append(name)
+
+        for ks_key, row in csv_data.items():
+            data = json.dumps(dict(row))
+            old = conn.execute('SELECT data FROM rows WHERE keystore_id = ?',
+                               (ks_key,)).fetchone()
+            if old and old[0] == data:
+                continue
+            conn.execute('INSERT INTO rows (keystore_id, added, version, data) '
+                         'VALUES (?, ?, ?, ?) ON CONFLICT (keystore_id) DO '
+                         'UPDATE SET version = excluded.version, '
+                         'data = excluded.data', (ks_key, version, version, data))
+            changed += 1
+
+        if changed or len(fields) > get_meta(conn, 'exported_fields'):
+            set_meta(conn, 'version', version)
+
+    log.info('%d keystore row(s) changed in database.', changed)
+    return export_csv(conn, csv_path)
+
+def export_csv(conn, csv_path):
+    """
+    Bring CSV keystore up to date with the database. New rows are appended
+    when nothing else changed and the file is as last exported. Otherwise
+    the file is rewritten (see shared.file_write_atomic).
+        Parameters:
+            conn (obj): sqlite3 Connection
+            csv_path (str): External keystore read by freeZTP
+        Returns:
+            changed (bool): True if file was written
+    """
+    if not csv_path:
+        log.warning('External keystore path not set. CSV export skipped.')
+        return False
+
+    version = get_meta(conn, 'version')
+    exported = get_meta(conn, 'exported_version')
+    if version == exported and path.exists(csv_path):
+        log.info('External keystore unchanged. File not written.')
+        return False
+
+    fields = get_fields(conn)
+    updated = conn.execute('SELECT COUNT(*) FROM rows WHERE version > ? AND '
+                           'added <= ?', (exported, exported)).fetchone()[0]
+    appendable = (exported and not updated
+                  and len(fields) == get_meta(conn, 'exported_fields')
+                  and shared.file_stat(csv_path)
+                  == get_meta(conn, 'exported_stat'))
+
+    if appendable:
+        count = export_rows(conn, csv_path, fields, exported)
+    else:
+        count = export_all(conn, csv_path, fields)
+
+    with conn:
+        set_meta(conn, 'exported_version', version)
+        set_meta(conn, 'exported_fields', len(fields))
+        set_meta(conn, 'exported_stat', shared.file_stat(csv_path))
+
+    return count > 0
+
+def export_rows(conn, csv_path, fields, exported):
+    """
+    Add rows added since the last export to the end of the CSV keystore.
+    Existing lines are copied as is, without parsing, into a temp file that
+    replaces the CSV in one step (see shared.AtomicFile).
+        Parameters:
+            conn (obj): sqlite3 Connection
+            csv_path (str): External keystore read by freeZTP
+            fields (list): CSV headers
+            exported (int): Keystore version last exported
+        Returns:
+            count (int): Rows written
+    """
+    count = 0
+    with open(csv_path, 'r', newline='', encoding='utf-8') as csv_file, \
+            shared.AtomicFile(csv_path) as tmp:
+        shutil.copyfileobj(csv_file, tmp.file)
+        writer = csv.DictWriter(tmp.file, fieldnames=fields)
+        query = 'SELECT data FROM rows WHERE added > ? ORDER BY rowid'
+        for (data,) in conn.execute(query, (exported,)):
+            writer.writerow(json.loads(data))
+            count += 1
+        tmp.commit()
+
+    log.info('Appended %d line(s) to external keystore.', count)
+    return count
+
+def export_all(conn, csv_path, fields):
+    """
+    Rewrite the CSV keystore from the database. Skipped if the content
+    would not change.
+        Parameters:
+            conn (obj): sqlite3 Connection
+            csv_path (str): External keystore read by freeZTP
+            fields (list): CSV headers
+        Returns:
+            count (int): Rows written. 0 if file unchanged.
+    """
+    count = 0
+    csv_text = io.StringIO()
+    writer = csv.DictWriter(csv_text, fieldnames=fields)
+    writer.writeheader()
+    for (data,) in conn.execute('SELECT data FROM rows ORDER BY rowid'):
+        writer.writerow(json.loads(data))
+        count += 1
+    csv_text = csv_text.getvalue()
+
+    new_hash = hashlib.sha256(csv_text.encode('utf-8')).hexdigest()
+    if new_hash == shared.file_sha256(csv_path):
+        log.info('External keystore unchanged. File not written.')
+        return 0
+
+    shared.file_write_atomic(csv_path, csv_text)
+    log.info('Wrote %d line(s) to external keystore.', count)
+    return count
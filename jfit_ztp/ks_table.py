@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Compact in-memory external keystore. Column names are stored once per
+keystore and each row is a tuple of values, with repeated values
+(template names, site codes, etc.) interned. Rows are read and changed
+through dictionary-like views, so code written for a dict of row dicts
+works unchanged.
+
+    csv_data = KeystoreTable(['keystore_id', 'var'])
+    csv_data['MYHOST'] = {'keystore_id': 'myhost', 'var': 'value'}
+    csv_data['MYHOST']['var2'] = 'other'    # adds 'var2' column
+"""
+
+# Python native modules
+import sys
+from collections.abc import Mapping, MutableMapping
+
+class Fields(list):
+    """
+    CSV headers in file order. Membership and position checks use an
+    index instead of scanning the list.
+        Parameters:
+            names (list): Optional. Initial headers.
+    """
+    def __init__(self, names=()):
+        super().__init__()
+        self.pos = {}
+        for name in names:
+            self.append(name)
+
+    def __contains__(self, name):
+        return name in self.pos
+
+    def index(self, name, *args):
+        return self.pos[name]
+
+    def append(self, name):
+        if name in self.pos:
+            return
+        self.pos[name] = len(self)
+        super().append(name)
+
+    def extend(self, names):
+        for name in names:
+            self.append(name)
+
+def intern_value(value):
+    """
+    Shared copy of a string value. Other values returned as is.
+        Parameters:
+            value: Field value
+        Returns:
+            value: Interned if str
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+class KeystoreRow(Mapping):
+    """
+    Dictionary view of one keystore row. Every column is present; unset
+    values read as None. Setting an unknown column adds it to the keystore.
+    Columns are shared by every row, so they cannot be deleted from one row.
+    Set a value to None to clear it.
+        Parameters:
+            table (KeystoreTable): Keystore holding the row
+            ks_key (str): Upper case keystore_id
+    """
+    __slots__ = ('table', 'ks_key')
+
+    def __init__(self, table, ks_key):
+        self.table = table
+        self.ks_key = ks_key
+
+    def __getitem__(self, name):
+        pos = self.table.fields.pos[name]
+        values = self.table.rows[self.ks_key]
+        return values[pos] if pos < len(values) else None
+
+    def __setitem__(self, name, value):
+        fields = self.table.fields
+        fields.append(name)
+        pos = fields.pos[name]
+        values = list(self.table.rows[self.ks_key])
+        if pos >= len(values):
+            values.extend([None] * (pos + 1 - len(values)))
+        values[pos] = intern_value(value)
+        self.table.rows[self.ks_key] = tuple(values)
+
+    def __iter__(self):
+        return iter(self.table.fields)
+
+    def __len__(self):
+        return len(self.table.fields)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class KeystoreTable(MutableMapping):
+    """
+    External keystore rows keyed on upper case keystore_id.
+        Parameters:
+            headers (list): Optional. CSV headers.
+        Attributes:
+            fields (Fields): CSV headers, shared by every row
+            rows (dict): Row value tuples keyed on upper case keystore_id
+    """
+    def __init__(self, headers=()):
+        self.fields = Fields(headers)
+        self.rows = {}
+
+    def __getitem__(self, ks_key):
+        if ks_key not in self.rows:
+            raise KeyError(ks_key)
+        return KeystoreRow(self, ks_key)
+
+    def __setitem__(self, ks_key, row):
+        if isinstance(row, KeystoreRow) and row.table is self:
+            if row.ks_key == ks_key:
+                return
+            row = dict(row)
+        self.fields.extend(row)
+        values = [None] * len(self.fields)
+        for name, value in row.items():
+            values[self.fields.pos[name]] = value
+        self.add_list(ks_key, values)
+
+    def __delitem__(self, ks_key):
+        del self.rows[ks_key]
+
+    def __contains__(self, ks_key):
+        return ks_key in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add_list(self, ks_key, values):
+        """
+        Store a row read straight from CSV.
+            Parameters:
+                ks_key (str): Upper case keystore_id
+                values (list): Row values in header order
+        """
+        self.rows[ks_key] = tuple(intern_value(value) for value in values)
+
+    def iter_lists(self):
+        """
+        Row values for CSV output, padded to the current headers.
+            Yields:
+                values (tuple): Row values in header order
+        """
+        width = len(self.fields)
+        for values in self.rows.values():
+            if len(values) < width:
+                values = values + (None,) * (width - len(values))
+            yield values
+
+    def copy(self):
+        """
+        Independent copy. Changes to either table do not affect the other.
+            Returns:
+                table (KeystoreTable): Copy
+        """
+        table = KeystoreTable(self.fields)
+        # Row tuples are never changed in place, so they can be shared
+        table.rows = dict(self.rows)
+        return table
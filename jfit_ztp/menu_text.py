@@ -13,7 +13,7 @@ M_MAIN = '''
            MAIN
            ----
     1. Set JotForm API Key
-    2. Set freeZTP Keystore Type (CSV / CLI)
+    2. Set freeZTP Keystore Type (CLI / CSV / SQLITE)
     3. Configure Jotform Answer Mappings
     S. Save
     Q. Save and Quit
@@ -46,7 +46,7 @@ M_KEYSTORE_TYPE = '''
 
          ZTP KEYSTORE CONFIGURATION
          --------------------------
-    1. Toggle freeZTP Keystore Type (CLI / CSV)
+    1. Toggle freeZTP Keystore Type (CLI / CSV / SQLITE)
     2. Set External Keystore Path
     3. Toggle Import Unknown
     H. Display Help
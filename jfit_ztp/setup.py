@@ -11,7 +11,6 @@ import json
 from urllib.parse import quote
 
 # External modules
-import requests
 from jinja2 import Template as jinja
 
 # Private modules
@@ -30,6 +29,8 @@ def setup(config_file, mode): # pylint: disable=unused-argument
     config = shared.file_read_config(config_file)
     if not config:
         config = initialize_config()
+    shared.init_http_client(config['http_pool_size'], config['http_timeout'])
+    shared.set_jotform_url(config['jotform_url'])
 
     menu_main(config_file, config, mode, bc_path='')
 
@@ -51,6 +52,7 @@ def initialize_config():
               'webhook_url': None,
               'max_stack_size': 1,
               'data_map': {}}
+    config.update(shared.CFG_DEFAULTS)
     return config
 
 def menu_main(config_file, config, mode, bc_path):
@@ -156,7 +158,8 @@ def menu_keystore_main(config, bc_path):
         selection = input(f'{bc_path} > ')
 
         if selection == '1':
-            toggle_mode = 'csv' if toggle_mode == 'cli' else 'cli'
+            toggle_mode = {'cli': 'csv', 'csv': 'sqlite'}.get(toggle_mode,
+                                                              'cli')
         elif selection == '2':
             config['csv_path'] = prompt_csv_path()
         elif selection == '3':
@@ -347,7 +350,7 @@ def menu_webex_main(config, bc_path):
             config = select_room_id(config)
         elif selection == '4':
             merge_dict = shared.build_merge_data(config)
-            shared.send_webex_msg(merge_dict, tmpl.WEBEX_SETUP_MSG)
+            shared.send_webex_msg(merge_dict, 'WEBEX_SETUP_MSG')
         elif selection.lower() == 'x':
             config['bot_token'] = None
             config['room_id'] = None
@@ -395,7 +398,7 @@ def menu_webhook_main(config, bc_path):
             print(f'\r\n{payload}\r\n')
         elif selection == '3':
             merge_dict = shared.build_merge_data(config)
-            shared.send_webhook_msg(merge_dict, tmpl.WEBHOOK_SETUP_DICT)
+            shared.send_webhook_msg(merge_dict, 'WEBHOOK_SETUP_DICT')
         elif selection.lower() == 'h':
             print(help_text.HELP_WEBHOOK_URL_MENU)
         elif selection.lower() == 'q':
@@ -502,12 +505,12 @@ def select_form_id(config):
         Parameters / Returns:
             config (dict): Current configuration data
     """
-    base_url = 'https://api.jotform.com/user/forms'
+    base_url = f'{shared.JOTFORM_URL}/user/forms'
     api_filter = '?limit=1000&filter=' + quote('{"status":"ENABLED"}')
     url = base_url + api_filter
     headers = {'APIKEY': config['api_key']}
     payload = None
-    response = requests.request('GET', url, headers=headers, data=payload, timeout=10)
+    response = shared.http_request('GET', url, headers=headers, data=payload)
     form_set = {}
     if (response.status_code == 200
             and response.json()['resultSet']['count'] >= 1):
@@ -543,20 +546,20 @@ def select_submission(config, sample_file):
     api_key = config['api_key']
     form_id = config['form_id']
     response = shared.get_new_submissions(api_key, form_id)
+    batch = None
+    if response.status_code == 200:
+        batch = shared.SubmissionBatch.from_response(response)
 
-    if (response.status_code == 200
-            and response.json()['resultSet']['count'] >= 1):
+    if batch and batch.count >= 1:
         log.debug('Full Jotform Response (JSON):\r\n%s',
-                  json.dumps(response.json(), indent=4))
+                  json.dumps(batch.submissions, indent=4))
 
         submission_ids = []
-        for submission in response.json()['content']:
+        for submission in batch.submissions:
             submission_ids.append(submission['id'])
 
         ans = menu_generic_select(submission_ids, 'UNREAD SUBMISSIONS')
-        for submission in response.json()['content']:
-            if submission_ids[ans] == submission['id']:
-                sample = submission
+        sample = batch.submissions[ans]
 
         if sample:
             with open(sample_file, 'w', encoding='utf-8') as json_file:
@@ -565,7 +568,7 @@ def select_submission(config, sample_file):
 
     else:
         print(response.status_code)
-        print(json.dumps(response.json(), indent=4))
+        print(response.text)
         print(help_text.FAIL_SUBMISSION_SELECTOR)
 
     return sample, dwnld_state
@@ -615,7 +618,7 @@ def select_room_id(config):
         'Authorization': f'Bearer {bot_token}'
         }
     payload = None
-    response = requests.request('GET', url, headers=headers, data=payload, timeout=10)
+    response = shared.http_request('GET', url, headers=headers, data=payload)
     room_set = {}
     if response.status_code == 200:
         for room in response.json()['items']:
@@ -700,7 +703,7 @@ def test_jotform_api_key(api_key):
             result (str}: Succeeded or Failed
     """
     result = "Failed"
-    url = 'https://api.jotform.com/user/usage'
+    url = f'{shared.JOTFORM_URL}/user/usage'
     headers = {'APIKEY': api_key}
     payload = None
     try:
@@ -708,7 +711,7 @@ def test_jotform_api_key(api_key):
     except ValueError:
         print('Answer not Hex value.')
         return None
-    response = requests.request('GET', url, headers=headers, data=payload, timeout=10)
+    response = shared.http_request('GET', url, headers=headers, data=payload)
     if response.status_code == 200:
         result = "Succeeded"
     else:
@@ -734,7 +737,7 @@ def test_webex_bot_token(bot_token):
         'Authorization': f'Bearer {bot_token}'
         }
     payload = None
-    response = requests.request('GET', url, headers=headers, data=payload, timeout=10)
+    response = shared.http_request('GET', url, headers=headers, data=payload)
     if response.status_code == 200:
         result = "Succeeded"
     else:
@@ -5,19 +5,157 @@ Functions used by multiple modules.
 
 # Python native modules
 from os import path
+import os
 import logging
 import argparse
 import json
 from urllib.parse import quote
 import socket
+import tempfile
+import shutil
+import time
+import math
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    # Windows. Keystore locking unavailable.
+    fcntl = None
 
 # External modules
 import requests
-from jinja2 import Template as jinja
+import jinja2
+
+# Private modules
+from . import template_text as tmpl
 
 # Begin logging inside module, parent initializes configuration
 log = logging.getLogger(__name__)
 
+# Tuning options added after v2.0.1. Applied to older config files on read.
+CFG_DEFAULTS = {
+    'page_size': 100,
+    'ack_mode': 'cursor',
+    'http_pool_size': 10,
+    'http_timeout': 10,
+    'ack_workers': 4,
+    'api_daily_limit': 1000,
+    'api_reserve': 50,
+    'quota_refresh': 3600,
+    'jotform_url': 'https://api.jotform.com',
+    'exec_mode': 'batch',
+    'ztp_config_path': '/etc/ztp/ztp.cfg',
+    'state_diff': True,
+    'restart_quiet_secs': 0,
+    'restart_max_per_hour': 12,
+    'restart_ready_secs': 60,
+    'restart_status_cmd': 'ztp show status',
+    'sqlite_path': 'keystore.db',
+    'csv_stream': False,
+    'ks_cache_hash': False,
+    'ks_lock_timeout': 30,
+    'ks_wal': False,
+    'ks_wal_max': 500,
+    'ks_wal_history': False,
+    'ks_shard_rule': None,
+    'ks_shard_dir': None
+}
+
+# JotForm timestamp format (e.g. created_at)
+JF_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# JotForm API base URL. Changed by set_jotform_url (e.g. local stand-in).
+JOTFORM_URL = CFG_DEFAULTS['jotform_url']
+
+# Retries after JotForm answers HTTP 429 (rate limited)
+JF_RETRIES = 3
+
+# Long-lived HTTP client. Created by init_http_client or on first request.
+HTTP_CLIENT = None
+
+# JotForm API call budget. Created by init_api_quota. Tracking off if None.
+API_QUOTA = None
+
+# Jinja2 environment for notifications. Created on first use.
+JINJA_ENV = None
+
+# Compiled notification templates by template_text name
+TEMPLATES = {}
+
+# Host name used in notifications. Looked up on first use.
+HOST_FQDN = None
+
+class HttpClient:
+    """
+    Keep-alive HTTP client shared by all JotForm, WebEx and webhook calls.
+    Connections are pooled per host and reused for the life of the process.
+        Parameters:
+            pool_size (int): Maximum open connections per host
+            timeout (int|float): Default seconds to wait per call
+    """
+    def __init__(self, pool_size, timeout):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """
+        Send request over a pooled connection.
+            Parameters:
+                method (str): HTTP verb
+                url (str): Full URL
+                timeout (int|float): Optional. Overrides default timeout.
+                kwargs: Passed to requests (e.g. headers, data)
+            Returns:
+                response (str): Requests Response object with all properties.
+        """
+        timeout = timeout if timeout else self.timeout
+        return self.session.request(method, url, timeout=timeout, **kwargs)
+
+def init_http_client(pool_size=CFG_DEFAULTS['http_pool_size'],
+                     timeout=CFG_DEFAULTS['http_timeout']):
+    """
+    (Re)create the shared HTTP client.
+        Parameters:
+            pool_size (int): Maximum open connections per host
+            timeout (int|float): Default seconds to wait per call
+    """
+    global HTTP_CLIENT # pylint: disable=global-statement
+    HTTP_CLIENT = HttpClient(pool_size, timeout)
+    log.debug('HTTP client ready. Pool size: %d, Timeout: %ss',
+              pool_size, timeout)
+
+def set_jotform_url(url):
+    """
+    Point all JotForm API calls at a different base URL.
+        Parameters:
+            url (str): Base URL without trailing slash
+                ex. 'https://api.jotform.com' or 'http://127.0.0.1:8085'
+    """
+    global JOTFORM_URL # pylint: disable=global-statement
+    JOTFORM_URL = url.rstrip('/')
+    if JOTFORM_URL != CFG_DEFAULTS['jotform_url']:
+        log.info('Using JotForm API at %s', JOTFORM_URL)
+
+def http_request(method, url, **kwargs):
+    """
+    Send request through the shared HTTP client. Create client if needed.
+        Parameters:
+            method (str): HTTP verb
+            url (str): Full URL
+            kwargs: Passed to HttpClient.request (e.g. headers, data, timeout)
+        Returns:
+            response (str): Requests Response object with all properties.
+    """
+    if not HTTP_CLIENT:
+        init_http_client()
+    return HTTP_CLIENT.request(method, url, **kwargs)
+
 def parse_args():
     """
     Start argparse to provide help and read back CLI arguments
@@ -62,92 +200,691 @@ def file_read_config(config_file):
     if path.exists(config_file):
         with open(config_file, encoding='utf-8') as cfg_file:
             config = json.load(cfg_file)
+        for key, value in CFG_DEFAULTS.items():
+            config.setdefault(key, value)
         log.debug('Imported configuration from file, %s',  config_file)
     else:
         log.info('Unable to import configuration.')
 
     return config
 
-def get_new_submissions(api_key, form_id):
+def get_new_submissions(api_key, form_id, limit=None, offset=0, cursor=None):
     """
     Query JotForm for new Submissions
         Parameters:
             api_key (hex): Jotform API Key value
             form_id (int): Jotform Form ID value
+            limit (int): Optional. Page size. JotForm default page if None.
+            offset (int): Optional. Position of first submission in page.
+            cursor (dict): Optional. Last processed submission. Queries by
+                creation time instead of the 'new' (unread) flag.
+                ex. {'created_at': '2025-01-31 13:45:00', 'id': '<num str>'}
         Returns:
             response (str): Requests Response object with all properties.
     """
-    base_url = 'https://api.jotform.com/form'
-    api_filter = quote('{"status":"ACTIVE","new":"1"}')
-    url = f'{base_url}/{form_id}/submissions?filter={api_filter}'
-    headers = {'APIKEY': api_key}
-    payload = None
-    response = requests.request('GET', url, headers=headers, data=payload, timeout=10)
+    base_url = f'{JOTFORM_URL}/form'
+    filter_dict = {'status': 'ACTIVE'}
+    if cursor:
+        # Back off 1 second so submissions sharing the cursor's timestamp are
+        # returned. Calling code drops the ones already processed.
+        cursor_time = datetime.strptime(cursor['created_at'], JF_TIME_FORMAT)
+        query_time = cursor_time - timedelta(seconds=1)
+        filter_dict['created_at:gt'] = query_time.strftime(JF_TIME_FORMAT)
+    else:
+        filter_dict['new'] = '1'
+    api_filter = quote(json.dumps(filter_dict, separators=(',', ':')))
+    # Oldest first. A run cut short by the API budget leaves only newer
+    # submissions behind, so the cursor never skips unprocessed work.
+    url = (f'{base_url}/{form_id}/submissions?filter={api_filter}'
+           '&orderby=created_at&direction=ASC')
+    if limit:
+        url += f'&limit={limit}&offset={offset}'
+    response = jotform_request('GET', url, api_key)
     # Error checking in calling code.
     return response
 
-def mark_submissions_read(api_key, submission_ids):
+def iter_new_submissions(api_key, form_id, page_size, cursor=None,
+                         keep_ids=None, max_count=None, status=None):
     """
-    Query JotForm for new Submissions
+    Walk every page of new submissions. The next page is requested in the
+    background while calling code works through the current page.
+        Parameters:
+            api_key (hex): Jotform API Key value
+            form_id (int): Jotform Form ID value
+            page_size (int): Submissions requested per page
+            cursor (dict): Optional. Last processed submission. See
+                get_new_submissions.
+            keep_ids (set): Optional. Question IDs kept in each answer set.
+                See SubmissionBatch.
+            max_count (int): Optional. Stop after this many submissions.
+            status (dict): Optional. Filled in as pages arrive.
+                'ordered': False once a submission arrives older than the
+                    one before it (JotForm ignored the requested order)
+                'truncated': True if submissions may be left unread,
+                    because max_count was reached or a page failed
+        Yields:
+            submission (dict): Jotform submission data
+                ex. {'id': '<num str>', 'answers': {<dict>}}
+    """
+    status = {} if status is None else status
+    status.update({'ordered': True, 'truncated': False})
+    seen_ids = set()
+    last_key = None
+    offset = 0
+    max_count = math.inf if max_count is None else max_count
+    cursor_key = submission_key(cursor) if cursor else None
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        args = (api_key, form_id, page_size, offset, cursor, keep_ids)
+        future = pool.submit(get_submission_batch, *args)
+        while future:
+            batch = future.result()
+            future = None
+            if not batch:
+                # Error logged in get_submission_batch
+                status['truncated'] = True
+                return
+
+            # Short page means the backlog is drained. Otherwise prefetch.
+            offset += batch.count
+            more = len(seen_ids) + batch.count < max_count
+            if batch.count >= page_size and more:
+                args = (api_key, form_id, page_size, offset, cursor, keep_ids)
+                future = pool.submit(get_submission_batch, *args)
+            elif batch.count >= page_size:
+                status['truncated'] = True
+
+            for submission in batch.submissions:
+                # Newer arrivals can shift a page boundary. Skip repeats.
+                if submission['id'] in seen_ids:
+                    continue
+                sub_key = submission_key(submission)
+                if last_key and sub_key < last_key:
+                    status['ordered'] = False
+                last_key = sub_key
+                if cursor_key and sub_key <= cursor_key:
+                    continue
+                if len(seen_ids) >= max_count:
+                    log.info('API budget for this run reached after %d '
+                             'submission(s).', len(seen_ids))
+                    status['truncated'] = True
+                    return
+                seen_ids.add(submission['id'])
+                yield submission
+
+def get_submission_batch(api_key, form_id, limit, offset, cursor=None,
+                         keep_ids=None):
+    """
+    Fetch and decode one page of new submissions.
+        Parameters:
+            See get_new_submissions and SubmissionBatch.
+        Returns:
+            batch (SubmissionBatch): Decoded page. None on HTTP error.
+    """
+    response = get_new_submissions(api_key, form_id, limit, offset, cursor)
+    if response.status_code != 200:
+        log.warning('Jotform Response & Headers (Plain):\r\n%s\r\n\r\n%s',
+                    response.text, response.headers)
+        return None
+
+    batch = SubmissionBatch.from_response(response, keep_ids)
+    if API_QUOTA and 'limit-left' in batch.metadata:
+        API_QUOTA.report(batch.metadata['limit-left'])
+    log.debug('Jotform page at offset %d. Metadata: %s\r\nSubmissions '
+              '(JSON):\r\n%s', offset, batch.metadata,
+              json.dumps(batch.submissions, indent=4))
+    return batch
+
+class SubmissionBatch:
+    """
+    One page of JotForm submissions. Response body is decoded only once.
+        Parameters:
+            payload (dict): Decoded JotForm response body
+            keep_ids (set): Optional. Question IDs kept in each answer set.
+                Unused answers are dropped at ingest. All kept if None.
+        Attributes:
+            count (int): Number of submissions in page
+            submissions (list): Submission dictionaries
+            metadata (dict): Remaining response fields
+                ex. {'responseCode': 200, 'resultSet': {<dict>}}
+    """
+    def __init__(self, payload, keep_ids=None):
+        self.submissions = payload.pop('content', None) or []
+        self.metadata = payload
+        self.count = len(self.submissions)
+        if keep_ids is not None:
+            for submission in self.submissions:
+                answers = submission.get('answers') or {}
+                submission['answers'] = {q_id: answer for q_id, answer
+                                         in answers.items() if q_id in keep_ids}
+
+    @classmethod
+    def from_response(cls, response, keep_ids=None):
+        """
+        Build batch from HTTP response.
+            Parameters:
+                response (obj): Requests Response object
+                keep_ids (set): Optional. See class docstring.
+            Returns:
+                batch (SubmissionBatch): Decoded page
+        """
+        return cls(response.json(), keep_ids)
+
+def submission_key(submission):
+    """
+    Sort key for submissions and cursors. Submission IDs increase with time,
+    so the ID orders submissions created in the same second.
+        Parameters:
+            submission (dict): Jotform submission or cursor data
+                ex. {'created_at': '2025-01-31 13:45:00', 'id': '<num str>'}
+        Returns:
+            key (tuple): (created_at, id)
+    """
+    return submission['created_at'], int(submission['id'])
+
+def file_read_cursor(cursor_file):
+    """
+    Read high-water mark of processed submissions. Return none if file absent.
+        Parameters:
+            cursor_file (str): Relative or absolute path.
+        Returns:
+            cursor (dict): {'created_at': '<timestamp>', 'id': '<num str>'}
+    """
+    cursor = None
+    if path.exists(cursor_file):
+        with open(cursor_file, encoding='utf-8') as json_file:
+            cursor = json.load(json_file)
+        log.debug('Submission cursor: %s', cursor)
+    else:
+        log.info('No submission cursor. Searching for unread submissions.')
+
+    return cursor
+
+def file_write_cursor(cursor_file, cursor):
+    """
+    Save high-water mark of processed submissions.
+        Parameters:
+            cursor_file (str): Relative or absolute path.
+            cursor (dict): {'created_at': '<timestamp>', 'id': '<num str>'}
+    """
+    file_write_atomic(cursor_file, json.dumps(cursor, indent=4))
+    log.debug('Submission cursor moved to %s', cursor)
+
+def file_read_outbox(outbox_file):
+    """
+    Read IDs of submissions applied to freeZTP but not yet marked 'read'.
+        Parameters:
+            outbox_file (str): Relative or absolute path.
+        Returns:
+            outbox (list): Submission IDs. Empty if file absent.
+                ex. ['<numeric string>', '<numeric string>']
+    """
+    outbox = []
+    if path.exists(outbox_file):
+        with open(outbox_file, encoding='utf-8') as json_file:
+            outbox = json.load(json_file)
+        log.info('%d applied submission(s) waiting to be marked read.',
+                 len(outbox))
+
+    return outbox
+
+def file_write_outbox(outbox_file, outbox):
+    """
+    Save IDs of submissions applied to freeZTP but not yet marked 'read'.
+    File removed once empty.
+        Parameters:
+            outbox_file (str): Relative or absolute path.
+            outbox (list): Submission IDs
+    """
+    if outbox:
+        file_write_atomic(outbox_file, json.dumps(outbox, indent=4))
+        log.debug('Outbox: %s', ' '.join(outbox))
+    elif path.exists(outbox_file):
+        os.remove(outbox_file)
+        log.debug('Outbox empty. Removed %s', outbox_file)
+
+def file_write_atomic(file_name, text):
+    """
+    Replace file contents in one step. Readers see old or new file, never a
+    partial write. Permissions of an existing file are kept.
+        Parameters:
+            file_name (str): Relative or absolute path.
+            text (str): New file contents
+    """
+    with AtomicFile(file_name) as tmp:
+        tmp.file.write(text)
+        tmp.commit()
+
+class AtomicFile:
+    """
+    Temp file in the same folder as file_name. commit() puts it in place of
+    file_name in one step. Discarded if the block exits without commit().
+        Parameters:
+            file_name (str): Relative or absolute path.
+        Attributes:
+            file (obj): File open for writing
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        folder = path.dirname(path.abspath(file_name))
+        fd, self.tmp_name = tempfile.mkstemp(dir=folder, prefix='.jfit-',
+                                             suffix='.tmp')
+        self.file = os.fdopen(fd, 'w', newline='', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.file.closed:
+            self.discard()
+
+    def commit(self):
+        """ Flush to disk and replace file_name """
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            if path.exists(self.file_name):
+                shutil.copymode(self.file_name, self.tmp_name)
+            os.replace(self.tmp_name, self.file_name)
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self):
+        """ Remove temp file. file_name untouched. """
+        self.file.close()
+        if path.exists(self.tmp_name):
+            os.unlink(self.tmp_name)
+
+class FileLock:
+    """
+    Advisory lock shared with other processes (flock). Held on a separate
+    lock file because keystore writes replace the data file itself.
+        Parameters:
+            lock_file (str): Relative or absolute path. Created if absent.
+            exclusive (bool): Optional. Exclusive (writer) lock if True,
+                shared (reader) lock if False.
+    """
+    def __init__(self, lock_file, exclusive=True):
+        self.lock_file = lock_file
+        self.exclusive = exclusive
+        self.file = None
+
+    def acquire(self, timeout, interval=0.1):
+        """
+        Wait for the lock.
+            Parameters:
+                timeout (int|float): Seconds to wait before giving up
+                interval (int|float): Seconds between attempts
+            Returns:
+                locked (bool): False if timeout passed first
+        """
+        if not fcntl:
+            log.debug('File locking not supported. %s not locked.',
+                      self.lock_file)
+            return True
+
+        mode = fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
+        # Stays open while locked. Closed in release.
+        self.file = open(self.lock_file, 'a', encoding='utf-8')
+        start = time.monotonic()
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(self.file.fileno(), mode | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not waiting:
+                    log.info('Waiting for lock on %s held by another process.',
+                             self.lock_file)
+                    waiting = True
+                if time.monotonic() - start >= timeout:
+                    log.warning('Timed out after %ss waiting for lock on %s.',
+                                timeout, self.lock_file)
+                    self.file.close()
+                    self.file = None
+                    return False
+                time.sleep(interval)
+
+        if waiting:
+            log.info('Lock on %s acquired after %.1fs.', self.lock_file,
+                     time.monotonic() - start)
+        return True
+
+    def release(self):
+        """ Release the lock, if held. """
+        if self.file:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+def file_stat(file_name):
+    """
+    Size and modification time, used to spot edits made outside JFIT.
+        Parameters:
+            file_name (str): Relative or absolute path.
+        Returns:
+            stat (list): [size, mtime_ns]. None if file absent.
+    """
+    if not file_name or not path.exists(file_name):
+        return None
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def file_sha256(file_name):
+    """
+    SHA-256 of file contents.
+        Parameters:
+            file_name (str): Relative or absolute path.
+        Returns:
+            digest (str): Hex digest. None if file absent.
+    """
+    if not path.exists(file_name):
+        return None
+
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as bin_file:
+        for block in iter(lambda: bin_file.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def mark_submissions_read(api_key, submission_ids,
+                          max_workers=CFG_DEFAULTS['ack_workers']):
+    """
+    Mark submissions 'read' in JotForm. Updates sent concurrently.
         Parameters:
             api_key (hex): Jotform API Key value
             submission_ids (list): Set of Submission IDs to mark 'read'
                 ex. ['<numeric string>', '<numeric string>']
+            max_workers (int): Optional. Maximum updates in flight.
         Returns:
-            err_state (bool): True means 1 or more updates failed.
+            results (dict): True / False per ID for success / failure
+                ex. {'<numeric string>': True, '<numeric string>': False}
     """
-    err_set = None
-    err_state = False
-    headers = {'APIKEY': api_key}
     payload = {'submission[new]': '0'}
-    for item in submission_ids:
-        url = f'https://api.jotform.com/submission/{item}'
-        response = requests.request('POST', url, headers=headers, data=payload, timeout=10)
-        if response.status_code != 200:
-            err_set += f'\r\n{response.text}'
-            err_state = True
-            log.warning('HTTP response from Jotform not 200. Full response '
-                        'text:\r\n%s\r\n\r\nActual status code: %d',
-                        response.text, response.status_code)
+    failed = []
+
+    def mark_one(item):
+        url = f'{JOTFORM_URL}/submission/{item}'
+        try:
+            return jotform_request('POST', url, api_key, payload)
+        except requests.RequestException as err:
+            # Connection failure affects this ID only. Retried next run.
+            log.warning('Request to mark submission %s read failed: %s', item,
+                        err)
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        responses = pool.map(mark_one, submission_ids)
+        results = {}
+        for item, response in zip(submission_ids, responses):
+            results[item] = response is not None and response.status_code == 200
+            if not results[item]:
+                failed.append(item)
+            if response is not None and not results[item]:
+                log.warning('HTTP response from Jotform not 200 for submission '
+                            '%s. Full response text:\r\n%s\r\n\r\nActual '
+                            'status code: %d', item, response.text,
+                            response.status_code)
+
+    if failed:
+        log.warning('%d of %d submission(s) not marked read: %s', len(failed),
+                    len(submission_ids), ' '.join(failed))
 
     # Error checking in calling code.
-    return err_state
+    return results
 
-def get_answer_data(config, answer_dict, ans_idx):
+def jotform_request(method, url, api_key, payload=None):
     """
-    Extract answer string. (Or answer substring, if delimiter present.)
+    Send JotForm API request. Wait and retry when rate limited (HTTP 429).
         Parameters:
-            ans_dict (dict): Jotform response data for a question
-                ex. {'text': 'Question 2', 'answer': 'myserial : mymodel'}
-            ans_idx (int): Index of sub-answer. 0 for first/only, or n for
-            specific element of split string.
+            method (str): HTTP verb
+            url (str): Full URL
+            api_key (hex): Jotform API Key value
+            payload (dict): Optional. Form data.
         Returns:
-            sub_answer (str): Answer string or substring.
+            response (str): Requests Response object with all properties.
     """
-    null_answer = config['null_answer']
-    delimiter = config['delimiter']
-    full_answer = answer_dict['answer']
-    split_answer = full_answer.split(delimiter)
-    sub_answer = None
+    headers = {'APIKEY': api_key}
+    for attempt in range(JF_RETRIES + 1):
+        response = http_request(method, url, headers=headers, data=payload)
+        if API_QUOTA:
+            API_QUOTA.record(response)
+        if response.status_code != 429 or attempt == JF_RETRIES:
+            break
+        # Honor Retry-After (seconds) when sent. Otherwise back off 1, 2, 4...
+        retry_after = response.headers.get('Retry-After', '')
+        delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+        log.info('JotForm rate limit reached. Retrying in %ds.', delay)
+        time.sleep(delay)
+
+    return response
 
-    log.debug('Full Answer Text from JotForm: %s',  full_answer)
+class ApiQuota:
+    """
+    Tracks JotForm API calls left today. Seeded from /user/usage, counted
+    down per call, and corrected whenever JotForm reports a remaining limit.
+        Parameters:
+            daily_limit (int): API calls allowed per day by JotForm plan
+            state (dict): Optional. Saved tracker state (see state method)
+                ex. {'day': '2025-01-31', 'remaining': 812, 'checked': 1.7e9}
+    """
+    def __init__(self, daily_limit, state=None):
+        self.daily_limit = daily_limit
+        self.day = datetime.now().strftime('%Y-%m-%d')
+        self.remaining = None
+        self.checked = 0
+        self.lock = threading.Lock()
+        # Saved counts only valid for the day they were taken
+        if state and state.get('day') == self.day:
+            self.remaining = state['remaining']
+            self.checked = state['checked']
 
-    if ans_idx + 1 > len(split_answer) and full_answer != null_answer:
-        log.warning('JotForm answer has %d elements. Data map looking for'
-                    ' value in element %d. Possible delimiter mismatch'
-                    ' or Data Map is wrong. Re-run setup to alter Data Map.',
-                    len(split_answer), (ans_idx + 1))
+    def refresh(self, api_key):
+        """
+        Read today's API usage from JotForm.
+            Parameters:
+                api_key (hex): Jotform API Key value
+        """
+        url = f'{JOTFORM_URL}/user/usage'
+        response = http_request('GET', url, headers={'APIKEY': api_key})
+        if response.status_code == 200:
+            used = int(response.json()['content'].get('api', 0))
+            with self.lock:
+                self.remaining = self.daily_limit - used
+                self.checked = time.time()
+            log.debug('JotForm API usage today: %d of %d', used,
+                      self.daily_limit)
+        else:
+            log.warning('Unable to read JotForm API usage. Status code: %d',
+                        response.status_code)
+        self.record(response)
 
-    elif full_answer != null_answer:
-        answer_element = full_answer.split(delimiter)[int(ans_idx)]
-        sub_answer = answer_element.strip()
-        log.debug('Parsed "%s" from full answer.', answer_element)
+    def record(self, response):
+        """
+        Count one API call. Adopt remaining limit from headers, if present.
+            Parameters:
+                response (obj): Requests Response object
+        """
+        with self.lock:
+            if self.remaining is not None:
+                self.remaining -= 1
+        for header in ('limit-left', 'X-RateLimit-Remaining'):
+            if response.headers.get(header, '').isdigit():
+                self.report(response.headers[header])
+                break
 
-    else:
-        log.debug('Null answer found. Nothing returned to calling code.')
+    def report(self, limit_left):
+        """
+        Adopt remaining call count reported by JotForm.
+            Parameters:
+                limit_left (int|str): Calls left today
+        """
+        with self.lock:
+            self.remaining = int(limit_left)
 
-    return sub_answer
+    def state(self):
+        """
+        Tracker state for saving between runs.
+            Returns:
+                state (dict): {'day': <str>, 'remaining': <int>, 'checked': <float>}
+        """
+        with self.lock:
+            return {'day': self.day, 'remaining': self.remaining,
+                    'checked': self.checked}
 
+def init_api_quota(daily_limit, quota_file, api_key, refresh_secs):
+    """
+    Start JotForm API call tracking. Usage is read from JotForm when the
+    saved count is missing, from another day, or older than refresh_secs.
+        Parameters:
+            daily_limit (int): API calls per day. 0 or None disables tracking.
+            quota_file (str): Relative or absolute path.
+            api_key (hex): Jotform API Key value
+            refresh_secs (int): Maximum age of saved count in seconds
+        Returns:
+            quota (ApiQuota): Active tracker or None if disabled
+    """
+    global API_QUOTA # pylint: disable=global-statement
+    API_QUOTA = None
+    if not daily_limit:
+        return None
+
+    state = None
+    if path.exists(quota_file):
+        with open(quota_file, encoding='utf-8') as json_file:
+            state = json.load(json_file)
+
+    quota = ApiQuota(daily_limit, state)
+    if quota.remaining is None or time.time() - quota.checked > refresh_secs:
+        quota.refresh(api_key)
+
+    API_QUOTA = quota
+    return quota
+
+def file_write_quota(quota_file, quota):
+    """
+    Save JotForm API call tracking state.
+        Parameters:
+            quota_file (str): Relative or absolute path.
+            quota (ApiQuota): Active tracker
+    """
+    file_write_atomic(quota_file, json.dumps(quota.state(), indent=4))
+
+def get_backlog_count(api_key, form_id):
+    """
+    Query JotForm for number of unread submissions on form.
+        Parameters:
+            api_key (hex): Jotform API Key value
+            form_id (int): Jotform Form ID value
+        Returns:
+            backlog (int): Unread submissions. None on failure.
+    """
+    url = f'{JOTFORM_URL}/form/{form_id}'
+    response = jotform_request('GET', url, api_key)
+    backlog = None
+    if response.status_code == 200:
+        backlog = int(response.json()['content'].get('new', 0))
+
+    return backlog
+
+def size_run(budget, page_size, ack_cost):
+    """
+    Largest submission count whose fetch and acknowledgement calls fit the
+    API budget. Page size shrinks when the budget is smaller than a page.
+        Parameters:
+            budget (int): API calls available to this run
+            page_size (int): Configured submissions per page
+            ack_cost (int): API calls per submission to acknowledge it
+        Returns:
+            max_count (int): Submissions this run may take
+            page_size (int): Submissions per page for this run
+    """
+    # Solve pages + acknowledgements <= budget, then trim any rounding excess
+    max_count = max(budget * page_size // (ack_cost * page_size + 1), 0)
+    while (max_count and
+           math.ceil(max_count / page_size) + max_count * ack_cost > budget):
+        max_count -= 1
+
+    return max_count, max(min(page_size, max_count), 1)
+
+def compile_data_map(config):
+    """
+    Flatten data map into an extraction plan. Built once per run.
+        Parameters:
+            config (dict): Current configuration data
+        Returns:
+            plan (list): Entries in data map order
+                ex. [('keystore_id', '3', 0, 'keystore_id'),
+                     ('idarray_1', '4', 0, 'idarray'),
+                     ('model', '4', 1, 'custom')]
+                kind is one of: keystore_id, idarray, association, custom
+    """
+    plan = []
+    for key, value in config['data_map'].items():
+        if 'keystore_id' in key:
+            kind = 'keystore_id'
+        elif 'idarray_' in key:
+            kind = 'idarray'
+        elif 'association' in key:
+            kind = 'association'
+        else:
+            kind = 'custom'
+        plan.append((key, value['a_id'], int(value['a_idx']), kind))
+
+    return plan
+
+def extract_answers(plan, answer_set, null_answer, delimiter):
+    """
+    Evaluate extraction plan against one submission. Each answer is split
+    at most once, and the keystore ID is resolved in the same pass.
+        Parameters:
+            plan (list): Output of compile_data_map
+            answer_set (dict): Set of answer dictionaries from Jotform
+                ex. {'1': {'text': 'Question 1', 'answer': 'myhostname'}}
+            null_answer (str): Answer text meaning 'no value'
+            delimiter (str): Separator for compound answers
+        Returns:
+            keystore_id (str): ID value, typically device hostname
+            values (list): (variable, kind, value) for all other entries.
+                Value is None for null answers (clears field).
+    """
+    keystore_id = None
+    values = []
+    split_cache = {}
+
+    for key, a_id, a_idx, kind in plan:
+        full_answer = answer_set[a_id]['answer']
+        sub_answer = None
+
+        if full_answer != null_answer:
+            split_answer = split_cache.get(a_id)
+            if split_answer is None:
+                log.debug('Full Answer Text from JotForm: %s',  full_answer)
+                split_answer = full_answer.split(delimiter)
+                split_cache[a_id] = split_answer
+
+            if a_idx < len(split_answer):
+                sub_answer = split_answer[a_idx].strip()
+                log.debug('Parsed "%s" from full answer.', sub_answer)
+            else:
+                log.warning('JotForm answer has %d elements. Data map looking'
+                            ' for value in element %d. Possible delimiter'
+                            ' mismatch or Data Map is wrong. Re-run setup to'
+                            ' alter Data Map.', len(split_answer), a_idx + 1)
+
+        if kind == 'keystore_id':
+            keystore_id = sub_answer
+        else:
+            values.append((key, kind, sub_answer))
+
+    return keystore_id, values
 
 def build_merge_data(cfg, ks_id=None, sub_id=None):
     """
@@ -160,24 +897,63 @@ def build_merge_data(cfg, ks_id=None, sub_id=None):
         Returns:
             merge_dict (dict): Combined items + uniques defined here
     """
+    global HOST_FQDN # pylint: disable=global-statement
+    if HOST_FQDN is None:
+        HOST_FQDN = socket.getfqdn().lower()
+
     merge_dict = cfg.copy()
     merge_dict['keystore_id'] = ks_id
     merge_dict['submission_id'] = sub_id
-    merge_dict['host_fqdn'] = (socket.getfqdn().lower())
+    merge_dict['host_fqdn'] = HOST_FQDN
     return merge_dict
 
+def load_template(name):
+    """
+    Template source for the Jinja2 loader. Webhook payload templates (dict)
+    are serialized to JSON here, once per process.
+        Parameters:
+            name (str): Template name in template_text. ex. 'WEBEX_WORKER_MSG'
+        Returns:
+            source (str): Template text with Jinja2 tags
+    """
+    template = getattr(tmpl, name)
+    if isinstance(template, dict):
+        template = json.dumps(template)
+    return template
+
+def get_template(name):
+    """
+    Compiled notification template. Each template is compiled once per
+    process. Compiled code is kept in Jinja2's bytecode cache (per user temp
+    folder, checked against the template text), so later runs skip
+    compiling as well.
+        Parameters:
+            name (str): Template name in template_text. ex. 'WEBEX_WORKER_MSG'
+        Returns:
+            compiled (obj): jinja2 Template. Call render(merge_dict).
+    """
+    global JINJA_ENV # pylint: disable=global-statement
+    compiled = TEMPLATES.get(name)
+    if compiled is None:
+        if JINJA_ENV is None:
+            JINJA_ENV = jinja2.Environment(
+                loader=jinja2.FunctionLoader(load_template),
+                bytecode_cache=jinja2.FileSystemBytecodeCache())
+        compiled = TEMPLATES[name] = JINJA_ENV.get_template(name)
+    return compiled
+
 def send_webex_msg(merge_dict, template):
     """
-    Query JotForm for new Submissions
+    Send message to WebEx room
         Parameters:
-            markdown = '<message text in markdown format>'
-            bot_token = '<string>'
-            room_id = '<hex string>'
+            merge_dict (dict): Merge data, incl. 'bot_token' and 'room_id'
+            template (str): Markdown template name in template_text.
+                ex. 'WEBEX_WORKER_MSG'
     """
     bot_token = merge_dict['bot_token']
     room_id = merge_dict['room_id']
 
-    markdown = jinja(template).render(merge_dict)
+    markdown = get_template(template).render(merge_dict)
     payload = json.dumps({'roomId': room_id, 'markdown': markdown})
 
     url = 'https://webexapis.com/v1/messages'
@@ -185,7 +961,7 @@ def send_webex_msg(merge_dict, template):
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {bot_token}'
         }
-    response = requests.request('POST', url, headers=headers, data=payload, timeout=10)
+    response = http_request('POST', url, headers=headers, data=payload)
 
     log.debug('Attempting to send message to Teams Room')
 
@@ -197,16 +973,15 @@ def send_webhook_msg(merge_dict, template):
     """
     Send HTTP POST to webhook URL
         Parameters:
-            config (dict): Current configuration data
-            template (str): JSON payload template. Optional jinja tags.
-        Returns:
+            merge_dict (dict): Merge data, incl. 'webhook_url'
+            template (str): JSON payload template name in template_text.
+                ex. 'WEBHOOK_WORKER_DICT'
     """
-    tmpl_json = json.dumps(template)
-    payload = jinja(tmpl_json).render(merge_dict)
+    payload = get_template(template).render(merge_dict)
 
     url = merge_dict['webhook_url']
     headers = {'Content-Type': 'application/json'}
-    response = requests.request('POST', url, headers=headers, data=payload, timeout=10)
+    response = http_request('POST', url, headers=headers, data=payload)
 
     log.debug('Trying to send message to webhook: %s', url)
 
@@ -5,21 +5,35 @@ Main worker process.
 
 # Python native modules
 from os import path
+import os
 import logging
 import sys
-import json
-import csv
+import math
 import subprocess
+import shutil
+import json
+import time
 
 # External modules
 
 # Private modules
 from . import shared
-from . import template_text as tmpl
+from . import ztp_batch
+from . import ztp_config
+from . import ks_csv
+from . import ks_sqlite
+from . import ks_shard
 
 # Begin logging inside module, parent initializes configuration
 log = logging.getLogger(__name__)
 
+CURSOR_NAME = 'cursor.json'
+OUTBOX_NAME = 'outbox.json'
+QUOTA_NAME = 'quota.json'
+RESTART_NAME = 'restart.json'
+JOURNAL_NAME = 'journal.jsonl'
+RESTART_CMD = 'ztp service restart'
+
 def process_data(config_file, test_mode):
     """
     Operational data processing
@@ -29,201 +43,647 @@ def process_data(config_file, test_mode):
         # Error logged in file_read_config
         sys.exit()
 
+    shared.init_http_client(cfg['http_pool_size'], cfg['http_timeout'])
+    shared.set_jotform_url(cfg['jotform_url'])
+
+    restart_state = file_read_restart_state(RESTART_NAME)
+    quota = shared.init_api_quota(cfg['api_daily_limit'], QUOTA_NAME,
+                                  cfg['api_key'], cfg['quota_refresh'])
+
+    # Restart checked every run, even one stopped early (keystore busy, no
+    # API calls left). Changes from earlier runs may be waiting.
+    try:
+        process_batch(cfg, test_mode, restart_state, quota)
+    finally:
+        if not test_mode:
+            restart_if_due(cfg, restart_state)
+            file_write_restart_state(RESTART_NAME, restart_state)
+
+        if quota:
+            shared.file_write_quota(QUOTA_NAME, quota)
+            log.info('Remaining API Calls: %s', quota.remaining)
+
+        log.info('Script Execution Complete')
+
+def process_batch(cfg, test_mode, restart_state, quota):
+    """
+    Fetch new submissions and apply them to freeZTP.
+        Parameters:
+            cfg (dict): Current configuration data
+            test_mode (bool): Skip freeZTP changes and acknowledgements
+            restart_state (dict): Restart scheduler state (updated in place)
+            quota (ApiQuota): Active tracker or None if tracking disabled
+    """
     restart_ztp = False
     submission_ids = []
     cmd_set = []
+    wal_records = None
+    compact_now = False
+    if (cfg['ks_wal'] and cfg['keystore_type'] == 'csv'
+            and not cfg['ks_shard_rule']):
+        wal_records = []
+    outbox = shared.file_read_outbox(OUTBOX_NAME)
+
+    # Finish a batch interrupted in an earlier run before fetching more
+    journal = file_read_journal(JOURNAL_NAME)
+    if journal and not test_mode:
+        log.warning('Resuming interrupted batch: %d of %d command(s) already '
+                    'applied.', len(journal['applied']), len(journal['cmds']))
+        outbox = apply_journal(cfg, journal, outbox, restart_state)
+
+    # Finish acknowledgements left over from an earlier run first. These
+    # submissions are already in freeZTP and are never applied again.
+    if outbox and not test_mode:
+        outbox = ack_outbox(cfg, outbox, [])
+
+    cursor = None
+    if cfg['ack_mode'] == 'cursor':
+        cursor = shared.file_read_cursor(CURSOR_NAME)
+
+    # 2025-09-24 - limit-left removed from responses due to API change.
+    # Opened ticket with JF. Budget now tracked from /user/usage.
+    max_count, page_size = plan_run(cfg, quota)
+
+    # Data map compiled once. Answers it does not use are dropped at ingest.
+    plan = shared.compile_data_map(cfg)
+    keep_ids = {a_id for _, a_id, _, _ in plan}
+    fetch_status = {'ordered': True, 'truncated': False}
+    submissions = ()
+    if max_count != 0:
+        submissions = shared.iter_new_submissions(
+            cfg['api_key'], cfg['form_id'], page_size, cursor, keep_ids,
+            max_count, fetch_status)
+    start_cursor = cursor
+
+    # Submissions are mapped as each page arrives. Only the newest
+    # submission per keystore ID is kept (net final state per device).
+    fetched = 0
+    latest = {}
+    for submission in submissions:
+        fetched += 1
+        if submission['id'] in outbox:
+            log.info('Submission %s already applied. Waiting to be marked '
+                     'read.', submission['id'])
+            continue
+
+        # submission_ids used to mark items as 'read'
+        submission_ids.append(submission['id'])
+        sub_key = shared.submission_key(submission)
+        if not cursor or sub_key > shared.submission_key(cursor):
+            cursor = {'created_at': submission['created_at'],
+                      'id': submission['id']}
+
+        keystore_id, values = shared.extract_answers(
+            plan, submission['answers'], cfg['null_answer'], cfg['delimiter'])
+
+        if not keystore_id:
+            log.critical('Mapping for keystore_id returned "None".  Skipping'
+                ' submission ID %s. Possible causes:\r\n  1. Null Answer is'
+                ' is permitted by JotForm. Configure a condition to prevent'
+                ' the Null Answer from being accepted for the Keystore ID'
+                ' (hostname).\r\n  2. There is an error in the data map.'
+                ' Re-run setup and validate the data mapping.', submission['id'])
+            continue
+
+        prior = latest.get(keystore_id.upper())
+        if prior and prior[0] > sub_key:
+            log.info('Submission %s for %s superseded by %s.',
+                     submission['id'], keystore_id, prior[1])
+            continue
+        if prior:
+            log.info('Submission %s for %s superseded by %s.',
+                     prior[1], keystore_id, submission['id'])
+        latest[keystore_id.upper()] = (sub_key, submission['id'], keystore_id,
+                                       values)
+
+    # Cursor skips everything at or before it. Unread submissions older than
+    # the newest one taken are only ruled out if pages came oldest first.
+    if fetch_status['truncated'] and not fetch_status['ordered']:
+        log.warning('JotForm returned submissions out of order and not all '
+                    'were read. Submission cursor not advanced.')
+        cursor = start_cursor
+
+    if len(latest) < len(submission_ids):
+        log.info('Coalesced %d submission(s) into %d device update(s).',
+                 len(submission_ids), len(latest))
+
+    if submission_ids:
+        log.info('New Submissions: %d', len(submission_ids))
+        log.debug('Submission Set: %s', ' '.join(submission_ids))
+    else:
+        log.info('No new submissions!')
 
-    response = shared.get_new_submissions(cfg['api_key'], cfg['form_id'])
+    if max_count and fetched >= max_count:
+        project_backlog(cfg, fetched, max_count)
+
+    # Apply net state per device in submission order
+    updates = sorted(latest.values())
+    notices = []
+    in_sync = False
+    if cfg['keystore_type'] == 'cli':
+        for _, sub_id, keystore_id, values in updates:
+            cmd_set.extend(submission_to_cli(keystore_id, values))
+            notices.append((keystore_id, sub_id))
+        restart_ztp = bool(updates)
+
+    elif updates:
+        # Keystore locked only once there is work to do. Held until written,
+        # so other writers cannot slip in between. Released on any exit.
+        ks_lock = lock_ext_ks(cfg)
+        if not ks_lock:
+            return
+        with ks_lock:
+            result = update_ext_ks(cfg, updates, wal_records, restart_state,
+                                   test_mode)
+        if result is None:
+            return
+        restart_ztp, in_sync, compact_now, notices = result
+
+    if submission_ids:
+        log.info('All submissions processed.')
 
-    # Process data only if new entries exist
-    if (response.status_code == 200
-            and response.json()['resultSet']['count'] >= 1):
-        response_count = response.json()['resultSet']['count']
-        # 2025-09-24 - Commented out due to API change. Opened ticket with JF.
-        # api_calls_left = response.json()['limit-left']
+    # Only send commands that change what freeZTP already holds
+    if cmd_set and cfg['state_diff']:
+        ztp_cfg = ztp_config.file_read_ztp_config(cfg['ztp_config_path'])
+        if ztp_cfg is not None:
+            cmd_count = len(cmd_set)
+            cmd_set = ztp_config.diff_cmds(ztp_cfg, cmd_set)
+            restart_ztp = bool(cmd_set)
+            in_sync = not cmd_set
+            log.info('%d of %d command(s) change freeZTP state.',
+                     len(cmd_set), cmd_count)
+
+    # Sent after the keystore is written and unlocked. Slow notification
+    # services no longer hold up other keystore writers.
+    for keystore_id, sub_id in notices:
+        send_notices(cfg, keystore_id, sub_id)
+
+    # Long change log folded early so replay at startup stays cheap
+    if compact_now:
+        ks_csv.compact_ext_ks(cfg)
+
+    # Post processing tasks (e.g. restart ZTP)
+    if restart_ztp:
+        log.debug('Commands to be sent to freeZTP CLI:\r\n%s',
+                  '\r\n'.join(cmd_set))
+        if not test_mode:
+            journal = {'cmds': cmd_set, 'applied': set(),
+                       'submission_ids': submission_ids, 'cursor': cursor}
+            file_start_journal(JOURNAL_NAME, journal)
+            outbox = apply_journal(cfg, journal, outbox, restart_state)
+
+    elif in_sync:
+        # freeZTP already matches every submission. Nothing to apply.
+        log.info('No data changes! ZTP not restarted.')
+        if not test_mode:
+            acknowledge(cfg, outbox, submission_ids, cursor)
+
+    elif submission_ids:
+        log.info('No data changes! ZTP not restarted.')
+
+def plan_run(cfg, quota):
+    """
+    Size this run's fetch and acknowledgement work to the API calls left.
+        Parameters:
+            cfg (dict): Current configuration data
+            quota (ApiQuota): Active tracker or None if tracking disabled
+        Returns:
+            max_count (int): Submissions this run may take. None if unlimited,
+                0 if no API calls are left for fetching.
+            page_size (int): Submissions per page for this run
+    """
+    if not quota or quota.remaining is None:
+        return None, cfg['page_size']
 
-        log.debug('Full Jotform Response (JSON):\r\n%s',
-                  json.dumps(response.json(), indent=4))
-        log.info('New Submissions: %d', response_count)
-        # log.info('Remaining API Calls: %d', api_calls_left)
+    budget = quota.remaining - cfg['api_reserve']
+    ack_cost = 0 if cfg['ack_mode'] == 'cursor' else 1
+    max_count, page_size = shared.size_run(budget, cfg['page_size'], ack_cost)
+    log.info('Remaining API Calls: %d (%d reserved). Run budget: %d '
+             'submission(s).', quota.remaining, cfg['api_reserve'], max_count)
 
-        # if api_calls_left < response_count:
-        #     log.warning('Insufficient remaining API calls to service current '
-        #           'submissions. Stopping script without processing.')
-        #     sys.exit()
+    if max_count < 1:
+        log.warning('Insufficient remaining API calls to service current '
+                    'submissions. Skipping fetch.')
 
-        if cfg['keystore_type'] == 'csv':
-            headers, csv_data = file_read_ext_ks(cfg['csv_path'])
-            if csv_data is None:
-                # Error logged in file_read_ext_ks
-                sys.exit()
+    return max_count, page_size
 
-        for submission in response.json()['content']:
-            # submission_ids used to mark items as 'read'
-            submission_ids.append(submission['id'])
+def project_backlog(cfg, fetched, max_count):
+    """
+    Log estimate of runs needed to drain submissions left by the API budget.
+        Parameters:
+            cfg (dict): Current configuration data
+            fetched (int): Submissions taken this run
+            max_count (int): Run budget in submissions
+    """
+    backlog = None
+    if cfg['ack_mode'] != 'cursor':
+        # Unread count still includes this run's submissions
+        backlog = shared.get_backlog_count(cfg['api_key'], cfg['form_id'])
+
+    if backlog is None:
+        # Cursor mode: JotForm has no count of submissions after a time
+        log.warning('Backlog larger than API budget. %d submission(s) taken. '
+                    'Remainder picked up by next run. Backlog size unknown.',
+                    fetched)
+    else:
+        left = max(backlog - fetched, 0)
+        log.warning('Backlog larger than API budget. %d submission(s) left. '
+                    'About %d more run(s) needed at %d per run.', left,
+                    math.ceil(left / max_count), max_count)
 
-            ans_set = submission['answers']
+def file_start_journal(journal_file, journal):
+    """
+    Write planned commands and batch details to a new journal.
+        Parameters:
+            journal_file (str): Relative or absolute path.
+            journal (dict): {'cmds': [<str>], 'applied': set(),
+                             'submission_ids': [<str>], 'cursor': {<dict>}}
+    """
+    lines = [json.dumps({'submission_ids': journal['submission_ids'],
+                         'cursor': journal['cursor']})]
+    for seq, command in enumerate(journal['cmds']):
+        lines.append(json.dumps({'seq': seq, 'cmd': command,
+                                 'status': 'planned'}))
+    shared.file_write_atomic(journal_file, '\n'.join(lines) + '\n')
+
+def file_read_journal(journal_file):
+    """
+    Read journal of an unfinished batch.
+        Parameters:
+            journal_file (str): Relative or absolute path.
+        Returns:
+            journal (dict): See file_start_journal. 'applied' holds the
+                positions of commands already run. None if no batch is open.
+    """
+    if not path.exists(journal_file):
+        return None
+
+    journal = {'cmds': [], 'applied': set()}
+    with open(journal_file, encoding='utf-8') as jnl_file:
+        for line in jnl_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Partial last line from an interrupted write
+                log.debug('Skipped unreadable journal line: %s', line)
+                continue
+            if 'submission_ids' in record:
+                journal.update(record)
+            elif record['status'] == 'planned':
+                journal['cmds'].append(record['cmd'])
+            else:
+                journal['applied'].add(record['seq'])
 
-            # Prepare ZTP updates based on keystore method: cli or csv.
-            if cfg['keystore_type'] == 'cli':
-                more_cmds, keystore_id = submission_to_cli(cfg, submission)
-                if more_cmds:
-                    restart_ztp = True
-                    cmd_set.extend(more_cmds)
+    return journal
 
-            else:
-                headers, csv_data, change_flag, keystore_id = (
-                    submission_to_csv(cfg, ans_set, headers, csv_data)
-                )
-                restart_ztp = True if change_flag else restart_ztp
+def apply_journal(cfg, journal, outbox, restart_state):
+    """
+    Run every journaled command not yet applied, checkpointing each one,
+    then acknowledge the batch and close the journal.
+        Parameters:
+            cfg (dict): Current configuration data
+            journal (dict): See file_start_journal
+            outbox (list): Submission IDs pending from earlier runs
+            restart_state (dict): Restart scheduler state (updated in place)
+        Returns:
+            outbox (list): Submission IDs still waiting to be marked 'read'
+    """
+    todo = [seq for seq in range(len(journal['cmds']))
+            if seq not in journal['applied']]
 
-            if cfg['bot_token'] and keystore_id:
-                merge_dict = shared.build_merge_data(cfg, keystore_id, submission['id'])
-                shared.send_webex_msg(merge_dict, tmpl.WEBEX_WORKER_MSG)
+    if todo:
+        with open(JOURNAL_NAME, 'a', encoding='utf-8') as jnl_file:
+            def checkpoint(position, result):
+                record = {'seq': todo[position], 'status': 'applied',
+                          'rc': result['rc']}
+                jnl_file.write(json.dumps(record) + '\n')
+                jnl_file.flush()
 
-            if cfg['webhook_url'] and keystore_id:
-                merge_dict = shared.build_merge_data(cfg, keystore_id, submission['id'])
-                shared.send_webhook_msg(merge_dict, tmpl.WEBHOOK_WORKER_DICT)
+            cmd_set = [journal['cmds'][seq] for seq in todo]
+            exec_cmds(cmd_set, cfg['exec_mode'], cfg['ztp_config_path'],
+                      checkpoint)
+        log.info('%d command(s) successfully sent to freeZTP CLI.', len(todo))
 
-        # Post processing tasks (e.g. restart ZTP)
-        log.info('All submissions processed.')
-        log.debug('Submission Set: %s', ' '.join(submission_ids))
+    outbox = acknowledge(cfg, outbox, journal['submission_ids'],
+                         journal['cursor'])
+    mark_restart_pending(restart_state)
 
-        if restart_ztp:
-            if cfg['keystore_type'] == 'csv' and csv_data:
-                file_write_ext_ks(cfg['csv_path'], headers, csv_data)
-
-            elif cfg['keystore_type'] == 'csv' and not csv_data:
-                log.warning('Referenced keystore empty (0 bytes) and Unknown '
-                    'Import disabled. Stopping script without marking new '
-                    'submissions as "read".')
-                sys.exit()
-
-            cmd_set.append('ztp service restart')
-            log.debug('Commands to be sent to freeZTP CLI:\r\n%s',
-                      '\r\n'.join(cmd_set))
-            if not test_mode:
-                exec_cmds(cmd_set)
-                log.info('%d command(s) successfully sent to freeZTP CLI.',
-                         len(cmd_set))
-                response = shared.mark_submissions_read(cfg['api_key'], submission_ids)
-                if not response:
-                    log.info('Submissions successfully marked as read.')
-                else:
-                    log.warning('Submissions failed to be marked as read.')
+    # Batch complete. Nothing left to resume.
+    os.remove(JOURNAL_NAME)
 
-        else:
-            log.info('No data changes! ZTP not restarted.')
+    return outbox
 
-    elif response.status_code == 200:
-        log.debug('Full Jotform Response (JSON):\r\n%s',
-                  json.dumps(response.json(), indent=4))
-        log.info('No new submissions!')
+def acknowledge(cfg, outbox, submission_ids, cursor):
+    """
+    Acknowledge processed submissions per 'ack_mode'.
+        Parameters:
+            cfg (dict): Current configuration data
+            outbox (list): Submission IDs pending from earlier runs
+            submission_ids (list): Submission IDs processed in this run
+            cursor (dict): Newest processed submission
+                ex. {'created_at': '2025-01-31 13:45:00', 'id': '<num str>'}
+        Returns:
+            outbox (list): Submission IDs still waiting to be marked 'read'
+    """
+    if cfg['ack_mode'] == 'cursor':
+        # One local write acknowledges the whole batch
+        if cursor:
+            shared.file_write_cursor(CURSOR_NAME, cursor)
+            log.info('Submission cursor saved.')
+    else:
+        outbox = ack_outbox(cfg, outbox, submission_ids)
+
+    return outbox
+
+def ack_outbox(cfg, outbox, submission_ids):
+    """
+    Mark applied submissions 'read'. IDs are saved to the outbox before any
+    API call, so a failure is retried next run instead of being re-applied.
+        Parameters:
+            cfg (dict): Current configuration data
+            outbox (list): Submission IDs pending from earlier runs
+            submission_ids (list): Submission IDs applied in this run
+        Returns:
+            outbox (list): Submission IDs still pending (failed)
+    """
+    pending = outbox + [item for item in submission_ids if item not in outbox]
+    shared.file_write_outbox(OUTBOX_NAME, pending)
+
+    results = shared.mark_submissions_read(cfg['api_key'], pending,
+                                           cfg['ack_workers'])
+    outbox = [item for item in pending if not results[item]]
+    shared.file_write_outbox(OUTBOX_NAME, outbox)
+
+    if outbox:
+        # Failed IDs logged in mark_submissions_read
+        log.warning('Submissions failed to be marked as read. %d kept in '
+                    'outbox for next run.', len(outbox))
     else:
-        log.warning('Jotform Response & Headers (Plain):\r\n%s',
-                  response.text + '\r\n\r\n' + response.headers)
+        log.info('Submissions successfully marked as read.')
 
-    log.info('Script Execution Complete')
+    return outbox
 
-def file_read_ext_ks(ext_keystore_file):
+def file_read_restart_state(state_file):
     """
-    Read external keystore fields / rows
+    Read freeZTP restart scheduler state. Defaults if file absent.
         Parameters:
-            ext_keystore_file (str): Absolute or relative path
+            state_file (str): Relative or absolute path.
         Returns:
-            headers (list): First row of CSV file
-            csv_data (dict): Row data using 'keystore_id' as key value
-                ex. {'MYHOST': {'keystore_id': 'myhost', 'var': 'value'}}
-    """
-    headers = None
-    csv_data = None
-
-    if path.exists(ext_keystore_file):
-        log.debug('Importing external keystore file, %s',  ext_keystore_file)
-        with open(ext_keystore_file, 'r', encoding='utf-8') as csv_file:
-            reader = csv.DictReader(csv_file)
-            headers = reader.fieldnames
-            csv_data = {}
-            # Create dictionary wrapper keyed on keystore_id.
-            for row in reader:
-                csv_data[row['keystore_id'].upper()] = row
-            log.info('Read %d lines from external keystore.', reader.line_num)
+            state (dict): {'pending': <bool>, 'last_change': <epoch>,
+                           'history': [<epoch of recent restarts>]}
+    """
+    state = {'pending': False, 'last_change': 0, 'history': []}
+    if path.exists(state_file):
+        with open(state_file, encoding='utf-8') as json_file:
+            state.update(json.load(json_file))
+
+    return state
+
+def file_write_restart_state(state_file, state):
+    """
+    Save freeZTP restart scheduler state.
+        Parameters:
+            state_file (str): Relative or absolute path.
+            state (dict): See file_read_restart_state
+    """
+    shared.file_write_atomic(state_file, json.dumps(state, indent=4))
 
+def mark_restart_pending(state):
+    """
+    Record that freeZTP must restart for new changes and save the state.
+        Parameters:
+            state (dict): Restart scheduler state (updated in place)
+    """
+    state['pending'] = True
+    state['last_change'] = time.time()
+    file_write_restart_state(RESTART_NAME, state)
+
+def restart_if_due(cfg, state):
+    """
+    Restart freeZTP for pending changes once the quiet window has passed
+    and the hourly restart budget allows. Otherwise the restart stays
+    pending for a later run, coalescing further changes into it.
+        Parameters:
+            cfg (dict): Current configuration data
+            state (dict): Restart scheduler state (updated in place)
+        Returns:
+            restarted (bool): True if a restart was issued
+    """
+    now = time.time()
+    state['history'] = [item for item in state['history'] if now - item < 3600]
+    if not state['pending']:
+        return False
+
+    quiet_left = cfg['restart_quiet_secs'] - (now - state['last_change'])
+    if quiet_left > 0:
+        log.info('freeZTP restart pending. Waiting %ds for more changes.',
+                 quiet_left)
+        return False
+
+    if len(state['history']) >= cfg['restart_max_per_hour']:
+        log.warning('freeZTP restart pending. Limit of %d restart(s) per hour '
+                    'reached. Deferred to a later run.',
+                    cfg['restart_max_per_hour'])
+        return False
+
+    # freeZTP reads the external keystore on restart. Merge shards or fold
+    # change log into the CSV first.
+    ks_ready = True
+    if cfg['keystore_type'] == 'csv' and cfg['ks_shard_rule']:
+        ks_ready = ks_shard.merge_ext_ks_shards(cfg)
+    elif cfg['keystore_type'] == 'csv':
+        ks_ready = ks_csv.compact_ext_ks(cfg)
+    if not ks_ready:
+        log.warning('freeZTP restart pending. Keystore changes not yet '
+                    'written to CSV.')
+        return False
+
+    results = exec_cmds([RESTART_CMD])
+    state['history'].append(now)
+    ready = results[0]['rc'] == 0 and wait_ztp_ready(
+        cfg['restart_status_cmd'], cfg['restart_ready_secs'])
+    state['pending'] = not ready
+    if ready:
+        log.info('freeZTP restarted and running.')
     else:
-        log.warning('Keystore missing. Verify file and path. Current: %s',
-                    ext_keystore_file)
+        log.warning('freeZTP not running %ds after restart. Restart stays '
+                    'pending.', cfg['restart_ready_secs'])
 
-    return headers, csv_data
+    return True
 
-def file_write_ext_ks(ext_keystore_file, headers, csv_data):
+def wait_ztp_ready(status_cmd, timeout, interval=2):
     """
-    Update external keystore fields / rows from JotForm Data
+    Poll freeZTP service status until it reports running.
         Parameters:
-            ext_keystore_file (str): Absolute or relative path
-            headers (list): First row of CSV file
-            csv_data (dict): Row data using 'keystore_id' as key value
-                ex. {'MYHOST': {'keystore_id': 'myhost', 'var': 'value'}}
+            status_cmd (str): Command printing service status
+                ex. 'ztp show status'
+            timeout (int|float): Seconds to keep polling
+            interval (int|float): Seconds between polls
         Returns:
-            None
+            ready (bool): True once status shows '(running)'
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            result = exec_cmd(status_cmd)
+        except OSError as err:
+            log.warning('Status command failed: %s', err)
+            return False
+        if result['rc'] == 0 and '(running)' in result['output']:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+
+def update_ext_ks(cfg, updates, wal_records, restart_state, test_mode):
+    """
+    Apply device updates to the external keystore (csv or sqlite) and write
+    it. Caller holds the keystore lock.
+        Parameters:
+            cfg (dict): Current configuration data
+            updates (list): (sub_key, sub_id, keystore_id, values) per device,
+                in submission order
+            wal_records (list): Change log records ('ks_wal'), else None
+            restart_state (dict): Restart scheduler state (updated in place)
+            test_mode (bool): Leave restart state untouched
+        Returns:
+            restart_ztp (bool): Keystore written. freeZTP must reload it.
+            in_sync (bool): Keystore already held every update
+            compact_now (bool): Change log due to be folded into the CSV
+            notices (list): (keystore_id, sub_id) per device to notify
+            None returned instead if the keystore cannot be used.
+    """
+    restart_ztp = False
+    in_sync = False
+    compact_now = False
+    restart_before = None
+    notices = []
+    ks_db = None
+    keystore_ids = [item[2] for item in updates]
+    try:
+        if cfg['keystore_type'] == 'sqlite':
+            # Only rows for this batch's keystore IDs are loaded
+            ks_db = ks_sqlite.open_keystore(cfg['sqlite_path'],
+                                            cfg['csv_path'])
+            headers, csv_data = ks_sqlite.read_rows(ks_db, keystore_ids)
+        elif cfg['ks_shard_rule']:
+            headers, csv_data = ks_shard.read_ext_ks_shards(cfg, keystore_ids)
+        else:
+            headers, csv_data = ks_csv.read_ext_ks(cfg, keystore_ids)
+        if csv_data is None:
+            # Error logged in ks_csv.file_read_ext_ks
+            return None
+
+        for _, sub_id, keystore_id, values in updates:
+            headers, csv_data, change_flag, keystore_id = (
+                submission_to_csv(cfg, keystore_id, values, headers, csv_data,
+                                  wal_records)
+            )
+            restart_ztp = True if change_flag else restart_ztp
+            notices.append((keystore_id, sub_id))
+
+        if restart_ztp and cfg['keystore_type'] == 'csv' and not csv_data:
+            log.warning('Referenced keystore empty (0 bytes) and Unknown '
+                'Import disabled. Stopping script without marking new '
+                'submissions as "read".')
+            return None
+
+        # Restart recorded as owed before the keystore changes. A run that
+        # stops after the write still restarts freeZTP, instead of finding
+        # the keystore in sync and acknowledging without a reload.
+        if restart_ztp and not test_mode:
+            restart_before = dict(restart_state)
+            mark_restart_pending(restart_state)
+
+        # Rewritten only if content differs. Unchanged file needs no restart.
+        if restart_ztp and cfg['keystore_type'] == 'sqlite':
+            restart_ztp = ks_sqlite.update_keystore(ks_db, cfg['csv_path'],
+                                                    headers, csv_data)
+        elif restart_ztp and wal_records is not None:
+            # CSV itself updated when freeZTP next restarts
+            restart_ztp, compact_now = ks_csv.log_ext_ks(cfg, wal_records)
+        elif restart_ztp and cfg['ks_shard_rule']:
+            restart_ztp = ks_shard.write_ext_ks_shards(cfg, headers, csv_data)
+        elif restart_ztp:
+            restart_ztp = ks_csv.write_ext_ks(cfg, headers, csv_data)
+        else:
+            return restart_ztp, in_sync, compact_now, notices
+        in_sync = not restart_ztp
+
+    finally:
+        if ks_db:
+            ks_db.close()
+
+    if restart_before is not None and not restart_ztp:
+        # Keystore unchanged. Restart state put back as it was.
+        restart_state.update(restart_before)
+        file_write_restart_state(RESTART_NAME, restart_state)
+
+    return restart_ztp, in_sync, compact_now, notices
+
+def send_notices(cfg, keystore_id, sub_id):
     """
-    i = 0
+    Send WebEx and webhook notifications for one applied device update.
+        Parameters:
+            cfg (dict): Current configuration data
+            keystore_id (str): ID value, typically device hostname. Nothing
+                sent if None.
+            sub_id (str): JotForm submission ID
+    """
+    if not keystore_id or not (cfg['bot_token'] or cfg['webhook_url']):
+        return
+
+    # Merge data built once and shared by both notification types
+    merge_dict = shared.build_merge_data(cfg, keystore_id, sub_id)
+
+    if cfg['bot_token']:
+        shared.send_webex_msg(merge_dict, 'WEBEX_WORKER_MSG')
 
-    with open(ext_keystore_file, 'w', newline='', encoding='utf-8') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=headers)
-        writer.writeheader()
-        # Strip off dictionary wrapper and write data
-        for value in csv_data.values():
-            writer.writerow(value)
-            i += 1
-        log.info('Wrote %d line(s) to external keystore.', i)
+    if cfg['webhook_url']:
+        shared.send_webhook_msg(merge_dict, 'WEBHOOK_WORKER_DICT')
 
-def submission_to_cli(config, submission): # answer_set):
+def lock_ext_ks(cfg):
+    """
+    Take exclusive lock on the external keystore ('<csv_path>.lock').
+        Parameters:
+            cfg (dict): Current configuration data
+        Returns:
+            ks_lock (FileLock): Held lock. None if another process holds it
+                past 'ks_lock_timeout'.
+    """
+    ks_file = cfg['csv_path'] or cfg['sqlite_path']
+    ks_lock = shared.FileLock(f'{ks_file}.lock')
+    if not ks_lock.acquire(cfg['ks_lock_timeout']):
+        log.warning('External keystore busy. Stopping script without marking '
+                    'new submissions as "read".')
+        return None
+    return ks_lock
+
+def submission_to_cli(keystore_id, values):
     """
     Generates ZTP CLI commands from JotForm Data
         Parameters:
-            answer_set (dict): Set of answer dictionaries from Jotform
-                ex. {'1': {'text': 'Question 1', 'answer': 'myhostname'}}
-            config (dict): Current configuration data
+            keystore_id (str): ID value, typically device hostname
+            values (list): (variable, kind, value) from shared.extract_answers
+                ex. [('idarray_1', 'idarray', 'FOC1234X0AB')]
         Returns:
             cmd_set (list): Set of ZTP CLI commands to be issued.
                 ex. ['ztp set idarray <name> <serial>', 'another ztp command']
-            keystore_id (str): ID value, typically device hostname
     """
-    answer_set = submission['answers']
-    data_map = config['data_map']
     cmd_set = []
     device_id_set = []
 
-    # Get 'keystore_id' the hard way due to variable dependencies.
-    a_idx = data_map['keystore_id']['a_idx']
-    a_id = data_map['keystore_id']['a_id']
-    a_dict = answer_set[a_id]
-    keystore_id = shared.get_answer_data(config, a_dict, a_idx)
-
-    if not keystore_id:
-        log.critical('Mapping for keystore_id returned "None".  Skipping'
-            ' submission ID %s. Possible causes:\r\n  1. Null Answer is'
-            ' is permitted by JotForm. Configure a condition to prevent'
-            ' the Null Answer from being accepted for the Keystore ID'
-            ' (hostname).\r\n  2. There is an error in the data map.'
-            ' Re-run setup and validate the data mapping.', submission['id'])
-        return None, None
-
-    for key, value in data_map.items():
-        cmd = None
-        a_dict = answer_set[value['a_id']]
-        a_idx = value['a_idx']
-        a_data = shared.get_answer_data(config, a_dict, a_idx)
+    log.info('Processing submission for Keystore ID: %s', keystore_id)
 
-        if 'keystore_id' in key:
-            log.info('Processing submission for Keystore ID: %s', keystore_id)
+    for key, kind, a_data in values:
+        cmd = None
 
-        elif 'idarray_' in key:
+        if kind == 'idarray':
             if a_data:
                 device_id_set.append(a_data.upper())
                 log.debug('Device ID: %s',  a_data.upper())
 
-        elif 'association' in key:
+        elif kind == 'association':
             if a_data:
                 cmd = f'ztp set association id {keystore_id} template {a_data}'
                 log.debug('Association ID: %s',  a_data)
@@ -251,49 +711,50 @@ def submission_to_cli(config, submission): # answer_set):
 
     log.info('Finished parsing values for %s',  keystore_id)
 
-    return cmd_set, keystore_id
+    return cmd_set
 
-def submission_to_csv(config, answer_set, headers, csv_data):
+def submission_to_csv(config, keystore_id, values, headers, csv_data,
+                      changes=None):
     """
     Update external keystore fields / rows from JotForm Data
         Parameters:
             config (dict): Full JFIT configuration
-            answer_set (dict): Set of answer dictionaries from Jotform
-                ex. {'1': {'text': 'Question 1', 'answer': 'myhostname'}}
+            keystore_id (str): ID value, typically device hostname
+            values (list): (variable, kind, value) from shared.extract_answers
+                ex. [('idarray_1', 'idarray', 'FOC1234X0AB')]
             headers (list): Set of header values
                 ex. ['keystore_id', 'var_1', 'var_x']
-            csv_data (dict): Row data using 'keystore_id' as key value
-                ex. {'MYHOST': {'keystore_id': 'myhost', 'var': 'value'}}
+            csv_data (KeystoreTable): Row data using 'keystore_id' as key
+                value. See ks_csv.file_read_ext_ks.
+            changes (list): Optional. Change log records for fields that
+                differ are appended here (see ks_csv.file_read_ks_wal).
         Returns:
             headers (list): Header values, possibly updated
-            csv_data (dict): Data with updated row for 'keystore_id'
+            csv_data (KeystoreTable): Data with updated row for 'keystore_id'
             True/False indicating whether changes were made (ztp restart)
             keystore_id (str): ID value, typically device hostname
     """
     import_unknown = config['import_unknown']
-    data_map = config['data_map']
     csv_update = {}
 
-    for key, value in data_map.items():
-        a_dict = answer_set[value['a_id']]
-        a_idx = value['a_idx']
-        var_data = shared.get_answer_data(config, a_dict, a_idx)
-
-        if 'keystore_id' in key:
-            keystore_id = var_data
-            log.info('Processing submission for Keystore ID: %s',  keystore_id)
+    log.info('Processing submission for Keystore ID: %s',  keystore_id)
+    before = dict(csv_data.get(keystore_id.upper(), {}))
 
+    for key, kind, var_data in values:
+        # If value is None, then CSV field will be cleared.
+        if kind == 'idarray' and var_data:
+            csv_update.update({key: var_data.upper()})
+            log.debug('Variable Name: %s\tValue: %s', key, var_data.upper())
         else:
-            # If func returns None, then CSV field will be cleared.
-            if 'idarray_' in key and var_data:
-                csv_update.update({key: var_data.upper()})
-                log.debug('Variable Name: %s\tValue: %s', key, var_data.upper())
-            else:
-                csv_update.update({key: var_data})
-                log.debug('Variable Name: %s\tValue: %s', key, var_data)
+            csv_update.update({key: var_data})
+            log.debug('Variable Name: %s\tValue: %s', key, var_data)
 
     # Create partial entry if Import Unknown is enabled
     if keystore_id.upper() not in csv_data and import_unknown:
+        # On rare chance that source file is empty, create first header.
+        if not headers:
+            log.warning('Empty external keystore found. Creating keystore_id '
+                        'header.')
         csv_data.update({keystore_id.upper(): {'keystore_id': keystore_id}})
         log.warning('Unknown ID, %s, added to external keystore. Incomplete'
                     ' data may cause merge issues.', keystore_id)
@@ -308,6 +769,16 @@ def submission_to_csv(config, answer_set, headers, csv_data):
     args = [csv_data, headers, keystore_id, csv_update]
     headers, csv_data = update_csv_data(*args)
 
+    if changes is not None:
+        # Compared as written to CSV. A blank field reads back as ''.
+        row = csv_data[keystore_id.upper()]
+        diff = {key: value for key, value in row.items()
+                if ks_csv.csv_text(before.get(key))
+                != ks_csv.csv_text(value)}
+        if diff:
+            changes.append({'ts': time.time(), 'keystore_id': keystore_id,
+                            'set': diff})
+
     log.info('Finished updating CSV values for %s',  keystore_id)
     return headers, csv_data, True, keystore_id
 
@@ -315,48 +786,126 @@ def update_csv_data(csv_data, headers, keystore_id, csv_update):
     """
     Update row data
         Parameters:
-            csv_data (dict): Row data using 'keystore_id' as key value
-            headers (list): Set of header values
+            csv_data (KeystoreTable): Row data using 'keystore_id' as key value
+            headers (list): Set of header values (csv_data.fields)
             keystore_id (str): ID value, typically device hostname
             csv_update (dict): var:data pairs to update csv_data entry
         Returns:
             headers (list): Header values, possibly updated
-            csv_data (dict): Data with updated row for 'keystore_id'
+            csv_data (KeystoreTable): Data with updated row for 'keystore_id'
     """
     data = csv_data[keystore_id.upper()]
 
     for key, value in csv_update.items():
-        # On rare chance that source file is empty, create first header.
-        # Only occurs if Import Unknown is enabled.
-        if not headers:
-            headers = ['keystore_id']
-            log.warning('Empty external keystore found. Creating keystore_id '
-                        'header.')
-        # Check CSV headers for variable. Add if needed.
-        if key not in headers:
-            headers.append(key)
+        # Check CSV headers for variable. Setting the value adds it.
+        if key not in csv_data.fields:
             log.debug('Header for "%s" missing. Adding now.', key)
 
-        data.update({key: value})
-        csv_data.update({keystore_id.upper(): data})
+        data[key] = value
         log.debug('Updating "%s as %s for %s.', key, value, keystore_id)
 
-    return headers, csv_data
+    return csv_data.fields, csv_data
 
-def exec_cmds(cmd_set):
+def exec_cmds(cmd_set, exec_mode='subprocess', ztp_config_path=None,
+              on_result=None):
     """
     Send freeZTP commands to system CLI
         Parameters:
             cmd_set (list): List of commands to send to freeZTP CLI
                 ex. ['ztp set idarray <name> <serial>', 'another ztp command']
+            exec_mode (str): 'batch' runs all commands except a final
+                restart in one process (see ztp_batch.py). 'config' writes
+                changes straight to the freeZTP config file (see
+                ztp_config.py). 'subprocess' starts one process per command.
+            ztp_config_path (str): freeZTP config file. 'config' mode only.
+            on_result (func): Optional. Called with (position, result) as
+                each command completes. Used for journal checkpoints.
+        Returns:
+            results (list): Per command result in execution order. Failures
+                have a non-zero 'rc' (logged here).
+                ex. [{'cmd': 'ztp set ...', 'rc': 0, 'output': '...'}]
+    """
+    # Restart always runs last, on its own, after all changes are in place
+    restart = [cmd for cmd in cmd_set[-1:] if cmd == RESTART_CMD]
+    changes = cmd_set[:len(cmd_set) - len(restart)]
+
+    on_result = on_result if on_result else lambda position, result: None
+
+    results = []
+    if exec_mode == 'config' and changes:
+        results = ztp_config.apply_cmds(ztp_config_path, changes)
+        # Config file saved in one write. All applied at once.
+        for position, result in enumerate(results):
+            on_result(position, result)
+    elif exec_mode == 'batch' and changes:
+        results = exec_cmds_batch(changes, on_result)
+
+    # Anything batch / config mode did not complete falls back to subprocess
+    for command in changes[len(results):] + restart:
+        results.append(exec_cmd(command))
+        on_result(len(results) - 1, results[-1])
+
+    failed = [result['cmd'] for result in results if result['rc']]
+    if failed:
+        log.warning('%d freeZTP command(s) returned an error:\r\n%s',
+                    len(failed), '\r\n'.join(failed))
+
+    return results
+
+def exec_cmd(command):
+    """
+    Run one freeZTP command in its own process.
+        Parameters:
+            command (str): Full command. ex. 'ztp set idarray <name> <serial>'
         Returns:
-            [no var] (bool): True / False indicating success / failure
+            result (dict): {'cmd': <str>, 'rc': <int>, 'output': <str>}
     """
-    for command in cmd_set:
-        process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
-        output = process.communicate()[0]
+    process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    return {'cmd': command, 'rc': process.returncode,
+            'output': output.decode('utf-8', 'replace')}
 
-    # Last command restarts ZTP. Verify status. Error check in calling code.
-    success = '(running)' in str(output)
+def exec_cmds_batch(cmd_set, on_result):
+    """
+    Run freeZTP commands through one long-lived interpreter (ztp_batch.py).
+        Parameters:
+            cmd_set (list): List of commands to send to freeZTP CLI
+            on_result (func): Called with (position, result) as each
+                command completes
+        Returns:
+            results (list): Per command result for each command completed,
+                in order. Shorter than cmd_set if the runner stopped early.
+    """
+    ztp_path = shutil.which('ztp')
+    if not ztp_path:
+        log.warning('freeZTP CLI (ztp) not found on PATH. Batch execution '
+                    'unavailable.')
+        return []
+
+    # Use interpreter freeZTP is installed under (script shebang)
+    with open(ztp_path, 'rb') as ztp_file:
+        shebang = ztp_file.readline().decode('utf-8', 'replace')
+    if not shebang.startswith('#!') or 'python' not in shebang:
+        log.warning('%s is not a Python script. Batch execution unavailable.',
+                    ztp_path)
+        return []
+    interpreter = shebang[2:].split()
+
+    runner = path.join(path.dirname(path.abspath(__file__)), 'ztp_batch.py')
+    with subprocess.Popen(interpreter + [runner, ztp_path], text=True,
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE) as process:
+        process.stdin.write('\n'.join(cmd_set) + '\n')
+        process.stdin.close()
+        results = []
+        for line in process.stdout:
+            if line.startswith(ztp_batch.RESULT_PREFIX):
+                results.append(json.loads(line[len(ztp_batch.RESULT_PREFIX):]))
+                on_result(len(results) - 1, results[-1])
+
+    if process.returncode or len(results) < len(cmd_set):
+        log.warning('Batch runner stopped after %d of %d command(s). Exit '
+                    'code: %s', len(results), len(cmd_set), process.returncode)
+    else:
+        log.debug('Batch runner completed %d command(s).', len(results))
 
-    return success
+    return results
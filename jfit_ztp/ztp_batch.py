@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Batch runner for freeZTP CLI commands. Loads the ztp script once and runs
+every command inside this one interpreter, instead of starting a new
+Python process per command.
+
+Standalone on purpose: started by worker.exec_cmds with the interpreter
+freeZTP is installed under, which may not have JFIT-ZTP dependencies.
+
+Usage:
+    python3 ztp_batch.py /usr/bin/ztp < commands.txt
+
+Input (stdin): One command per line. ex. 'ztp set idarray HOST1 FOC123'
+Output (stdout): One result per command, as soon as it completes.
+    ex. '@@JFIT {"cmd": "ztp set ...", "rc": 0, "output": "..."}'
+    Lines without the '@@JFIT ' prefix are stray output and are ignored by
+    calling code.
+"""
+
+# Python native modules
+import contextlib
+import io
+import json
+import sys
+import traceback
+
+RESULT_PREFIX = '@@JFIT '
+
+def run_command(code, ztp_path, command):
+    """
+    Run one freeZTP command against the compiled ztp script.
+        Parameters:
+            code (code): Compiled ztp script
+            ztp_path (str): Path of ztp script
+            command (str): Full command. ex. 'ztp set keystore HOST1 var val'
+        Returns:
+            result (dict): {'cmd': <str>, 'rc': <int>, 'output': <str>}
+    """
+    output = io.StringIO()
+    sys.argv = [ztp_path] + command.split()[1:]
+    scope = {'__name__': '__main__', '__file__': ztp_path}
+    rc = 0
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            exec(code, scope) # pylint: disable=exec-used
+        except SystemExit as err:
+            if isinstance(err.code, int):
+                rc = err.code
+            elif err.code:
+                print(err.code)
+                rc = 1
+        except Exception: # pylint: disable=broad-except
+            traceback.print_exc()
+            rc = 1
+
+    return {'cmd': command, 'rc': rc, 'output': output.getvalue()}
+
+def main():
+    """ Compile ztp once, then run each command from stdin """
+    ztp_path = sys.argv[1]
+    with open(ztp_path, encoding='utf-8') as ztp_file:
+        code = compile(ztp_file.read(), ztp_path, 'exec')
+
+    commands = [line.strip() for line in sys.stdin.read().splitlines()]
+    out = sys.stdout
+    for command in commands:
+        if command:
+            result = run_command(code, ztp_path, command)
+            out.write(RESULT_PREFIX + json.dumps(result) + '\n')
+            out.flush()
+
+if __name__ == '__main__':
+    main()
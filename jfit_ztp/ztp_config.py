@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Direct freeZTP configuration writer. Applies keystore, idarray and
+association commands from worker.submission_to_cli to the freeZTP config
+file in memory, then saves the file once. Alternative to running one
+'ztp set ...' command per value.
+
+Supported commands:
+    ztp set keystore <id> <key> <value>
+    ztp clear keystore <id> <key | all>
+    ztp set idarray <id> <device id> [<device id> ...]
+    ztp set association id <id> template <template>
+    ztp clear association <id>
+"""
+
+# Python native modules
+from os import path
+import logging
+import json
+import copy
+
+# Private modules
+from . import shared
+
+# Begin logging inside module, parent initializes configuration
+log = logging.getLogger(__name__)
+
+def file_read_ztp_config(config_path):
+    """
+    Read freeZTP configuration file.
+        Parameters:
+            config_path (str): Absolute path. ex. '/etc/ztp/ztp.cfg'
+        Returns:
+            ztp_cfg (dict): freeZTP configuration. None if unreadable.
+    """
+    ztp_cfg = None
+    if path.exists(config_path):
+        try:
+            with open(config_path, encoding='utf-8') as cfg_file:
+                ztp_cfg = json.load(cfg_file)
+        except (OSError, ValueError) as err:
+            log.warning('Unable to read freeZTP config %s: %s', config_path,
+                        err)
+    else:
+        log.warning('freeZTP config missing. Verify file and path. Current: '
+                    '%s', config_path)
+
+    return ztp_cfg
+
+def file_write_ztp_config(config_path, ztp_cfg):
+    """
+    Save freeZTP configuration file (write to temp file, then rename).
+        Parameters:
+            config_path (str): Absolute path. ex. '/etc/ztp/ztp.cfg'
+            ztp_cfg (dict): freeZTP configuration
+    """
+    shared.file_write_atomic(config_path, json.dumps(ztp_cfg, indent=4,
+                                                     sort_keys=True))
+    log.info('Saved freeZTP config, %s', config_path)
+
+def apply_cmd(ztp_cfg, command):
+    """
+    Apply one freeZTP CLI command to configuration data.
+        Parameters:
+            ztp_cfg (dict): freeZTP configuration (updated in place)
+            command (str): Full command. ex. 'ztp set keystore HOST1 var val'
+        Returns:
+            applied (bool): False if command is not supported
+    """
+    words = command.split()
+    action = words[1:3]
+
+    if action == ['set', 'keystore'] and len(words) >= 6:
+        # Value is everything after the key, spaces included
+        ks_id, key, value = command.split(None, 5)[3:]
+        ztp_cfg.setdefault('keyvalstore', {}).setdefault(ks_id, {})[key] = value
+
+    elif action == ['clear', 'keystore'] and len(words) == 5:
+        ks_id, key = words[3:]
+        store = ztp_cfg.setdefault('keyvalstore', {})
+        if key == 'all':
+            store.pop(ks_id, None)
+        else:
+            store.get(ks_id, {}).pop(key, None)
+
+    elif action == ['set', 'idarray'] and len(words) >= 4:
+        ztp_cfg.setdefault('idarrays', {})[words[3]] = words[4:]
+
+    elif (action == ['set', 'association'] and len(words) == 7
+          and words[3] == 'id' and words[5] == 'template'):
+        ztp_cfg.setdefault('associations', {})[words[4]] = words[6]
+
+    elif action == ['clear', 'association'] and len(words) == 4:
+        ztp_cfg.setdefault('associations', {}).pop(words[3], None)
+
+    else:
+        return False
+
+    return True
+
+def cmd_target(command):
+    """
+    Locate the config entry a freeZTP command changes.
+        Parameters:
+            command (str): Full command. ex. 'ztp set keystore HOST1 var val'
+        Returns:
+            target (tuple): (section, id) ex. ('keyvalstore', 'HOST1').
+                None if command is not supported.
+    """
+    words = command.split()
+    sections = {'keystore': 'keyvalstore', 'idarray': 'idarrays',
+                'association': 'associations'}
+    if len(words) < 4 or words[1] not in ('set', 'clear'):
+        return None
+    if words[2] not in sections:
+        return None
+    # 'ztp set association id <id> ...' carries the ID one word later
+    ks_id = words[4] if words[3] == 'id' and len(words) > 4 else words[3]
+    return sections[words[2]], ks_id
+
+def diff_cmds(ztp_cfg, cmd_set):
+    """
+    Drop commands that would not change current freeZTP state. Kept
+    commands are applied to ztp_cfg so later commands see their effect.
+        Parameters:
+            ztp_cfg (dict): Current freeZTP configuration (updated in place)
+            cmd_set (list): List of freeZTP CLI commands
+        Returns:
+            changed (list): Commands that alter freeZTP state, in order
+    """
+    changed = []
+    for command in cmd_set:
+        target = cmd_target(command)
+        if not target:
+            # Unknown effect. Always send.
+            changed.append(command)
+            continue
+
+        section, ks_id = target
+        before = copy.deepcopy(ztp_cfg.get(section, {}).get(ks_id))
+        if not apply_cmd(ztp_cfg, command):
+            changed.append(command)
+        elif ztp_cfg.get(section, {}).get(ks_id) != before:
+            changed.append(command)
+        else:
+            log.debug('No change, skipped: %s', command)
+
+    return changed
+
+def apply_cmds(config_path, cmd_set):
+    """
+    Apply freeZTP commands directly to the config file. File is loaded and
+    saved once. Stops at the first unsupported command.
+        Parameters:
+            config_path (str): Absolute path. ex. '/etc/ztp/ztp.cfg'
+            cmd_set (list): List of freeZTP CLI commands
+        Returns:
+            results (list): Per command result for each command applied,
+                in order. Shorter than cmd_set if stopped early.
+                ex. [{'cmd': 'ztp set ...', 'rc': 0, 'output': ''}]
+    """
+    ztp_cfg = file_read_ztp_config(config_path)
+    if ztp_cfg is None:
+        # Error logged in file_read_ztp_config
+        return []
+
+    results = []
+    for command in cmd_set:
+        if not apply_cmd(ztp_cfg, command):
+            log.warning('Command not supported by config writer: %s', command)
+            break
+        results.append({'cmd': command, 'rc': 0, 'output': ''})
+
+    if results:
+        file_write_ztp_config(config_path, ztp_cfg)
+    log.info('%d of %d command(s) applied directly to freeZTP config.',
+             len(results), len(cmd_set))
+
+    return results